@@ -0,0 +1 @@
+FixupMultilibPaths now reports all conflicting or unfixable library files together instead of failing on the first one.
@@ -0,0 +1 @@
+Setting the pathownershipsnapshot macro to a directory keeps the local database's answers to path ownership queries there between cooks, so that repeated lookups need not query the database. It is an answer cache filled as paths are looked up, not a copy of the database: the first cook after the database changes still queries it for every path. Answers from every policy, including the enforcement policies and bootstrap builds, are recorded as they are found. The recorded answers are discarded whenever the database changes or a sample of them no longer matches it.
@@ -0,0 +1 @@
+An optional SQLite cache of installLabelPath query results lets repeated cooks on a build node skip repository round trips for file dependency and PHP interpreter lookups. Set the repositoryquerycache macro to the path of the cache file to enable it; repositoryquerycachettl sets how long answers are kept, in seconds (default 86400), and repositoryquerycachesize the maximum number of answers kept (default 100000). Only answers that found a trove are cached.
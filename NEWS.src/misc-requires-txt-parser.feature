@@ -0,0 +1 @@
+EggRequires now reads plain requires.txt files without importing pkg_resources, so python-setuptools is only needed for files using environment markers or other advanced syntax.
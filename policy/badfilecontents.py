@@ -22,6 +22,52 @@ from conary.lib import util
 from conary.build import policy, recipe
 
 
+# copied from permissions.py
+class _FileModes(object):
+    """
+    Modes of the files in the destdir, from one lstat per path shared
+    through the recipe by the enforcement policies that check file
+    permissions.  It is only used after the destdir has been packaged;
+    policies that change modes after that must call C{setMode}.
+    """
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.modes = {}
+
+    def getMode(self, path):
+        mode = self.modes.get(path)
+        if mode is None:
+            mode = os.lstat(self.destdir + path)[stat.ST_MODE]
+            self.modes[path] = mode
+        return mode
+
+    def setMode(self, path, mode):
+        self.modes[path] = mode
+
+
+def _getFileModes(recipe):
+    fileModes = getattr(recipe, '_fileModes', None)
+    if fileModes is None:
+        fileModes = _FileModes(recipe.macros.destdir)
+        recipe._fileModes = fileModes
+    return fileModes
+
+
+def _strippedLines(path):
+    """
+    Yield the non-blank lines of the file at path, stripped of leading
+    and trailing whitespace, reading only as far as the caller iterates.
+    """
+    f = file(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        f.close()
+
+
 class NonBinariesInBindirs(policy.EnforcementPolicy):
     """
     NAME
@@ -72,8 +118,7 @@ class NonBinariesInBindirs(policy.EnforcementPolicy):
         if hasattr(self.recipe, '_getCapsulePathsForFile'):
             if self.recipe._getCapsulePathsForFile(filename):
                 return
-        d = self.macros['destdir']
-        mode = os.lstat(util.joinPaths(d, filename))[stat.ST_MODE]
+        mode = _getFileModes(self.recipe).getMode(filename)
         if not mode & 0111:
             self.error(
                 "%s has mode 0%o with no executable permission in bindir",
@@ -234,8 +279,7 @@ class BadInterpreterPaths(policy.EnforcementPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        d = self.macros['destdir']
-        mode = os.lstat(util.joinPaths(d, path))[stat.ST_MODE]
+        mode = _getFileModes(self.recipe).getMode(path)
         if not mode & 0111:
             # we care about interpreter paths only in executable scripts
             return
@@ -357,9 +401,33 @@ class CheckDesktopFiles(policy.EnforcementPolicy):
         if hasattr(self.recipe, '_getCapsulePathsForFile'):
             if self.recipe._getCapsulePathsForFile(filename):
                 return
-        self.iconDirs = [ x % self.macros for x in self.iconDirs ]
         self.checkIcon(filename)
 
+    def preProcess(self):
+        self.iconDirs = [ x % self.macros for x in self.iconDirs ]
+        self.iconIndex = None
+
+    def _getIconIndex(self):
+        """
+        Return the sets of icon file names, and of the names with any
+        extension removed, found anywhere under the destdir datadir and
+        the icon directories.  Built once per policy run.
+        """
+        if self.iconIndex is None:
+            names = set()
+            stems = set()
+            fulldatadir = self.macros.destdir + '/' + self.macros.datadir
+            for iconDir in [ fulldatadir ] + self.iconDirs:
+                for root, dirs, files in os.walk(iconDir):
+                    names.update(files)
+            for name in names:
+                i = name.find('.')
+                while i != -1:
+                    stems.add(name[:i])
+                    i = name.find('.', i + 1)
+            self.iconIndex = (names, stems)
+        return self.iconIndex
+
     def checkIcon(self, filename):
         fullname = self.macros.destdir + '/' + filename
         iconfiles = [x.split('=', 1)[1].strip()
@@ -379,17 +447,12 @@ class CheckDesktopFiles(policy.EnforcementPolicy):
                 self.error('Illegal relative path Icon=%s in %s',
                            iconfilename, filename)
             else:
-                ext = '.' in iconfilename
-                fulldatadir = self.macros.destdir + '/' + self.macros.datadir
-                for iconDir in [ fulldatadir ] + self.iconDirs:
-                    for root, dirs, files in os.walk(iconDir):
-                        if ext:
-                            if iconfilename in files:
-                                return
-                        else:
-                            if [ x for x in files
-                                 if x.startswith(iconfilename+'.') ]:
-                                return
+                names, stems = self._getIconIndex()
+                if '.' in iconfilename:
+                    if iconfilename in names:
+                        return
+                elif iconfilename in stems:
+                    return
                 # didn't find anything
                 self.warn('%s says Icon=%s must exist, but it does not exist'
                            ' anywhere in: %s',
@@ -438,14 +501,8 @@ class RequireChkconfig(policy.EnforcementPolicy):
         fullpath = util.joinPaths(d, path)
         if not (os.path.isfile(fullpath) and util.isregular(fullpath)):
             return
-        f = file(fullpath)
-        lines = f.readlines()
-        f.close()
         foundChkconfig = False
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
+        for line in _strippedLines(fullpath):
             if not line.startswith('#'):
                 # chkconfig tag must come before any uncommented lines
                 break
@@ -20,10 +20,163 @@ import re
 import stat
 
 from conary.lib import magic, util
-from conary.build import policy, recipe
+from conary.build import filter, policy, recipe
 
 
-class BadFilenames(policy.EnforcementPolicy):
+def _readlink(recipe, path, st=None):
+    """
+    Return the contents of the symlink at C{path} in the destdir, or
+    None if C{path} is not a symlink, using the symlink table kept on
+    the recipe by the symlink policies when it exists.
+    """
+    table = getattr(recipe, '_symlinkTable', None)
+    if table is not None:
+        return table.readlink(path, st)
+    fullpath = recipe.macros.destdir + path
+    if st is None:
+        if not os.path.islink(fullpath):
+            return None
+    elif not stat.S_ISLNK(st.st_mode):
+        return None
+    return os.readlink(fullpath)
+
+
+class _PathLint(object):
+    """
+    Single pass over every path in the destdir, noting the paths that
+    break each of the rules that can be checked from the path name and
+    link contents alone.  The snapshot is taken the first time it is
+    needed, by the enforcement policies that run after the destdir has
+    been packaged; policies that change the destdir after that must
+    call C{invalidate}.
+    """
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.destdir = recipe.macros.destdir
+        self.builddir = recipe.macros.builddir
+        self.hits = None
+        self.links = {}
+
+    def invalidate(self):
+        self.hits = None
+        self.links = {}
+
+    def _scan(self):
+        self.links = {}
+        self.hits = dict((x, []) for x in
+            ('newline', 'utf8', 'destdir', 'lib64', 'link', 'regular'))
+        self._scanDir('', False, False)
+
+    def _scanDir(self, path, newlineDir, utf8Dir):
+        fullpath = self.destdir + path
+        try:
+            names = os.listdir(fullpath)
+        except OSError:
+            return
+        hits = self.hits
+        d = self.destdir
+        b = self.builddir
+        # check all the names in the directory at once; only look at
+        # them one at a time if one of them is bad
+        joined = '/'.join(names)
+        newlineNames = not newlineDir and joined.find('\n') != -1
+        utf8Names = False
+        if not utf8Dir:
+            try:
+                joined.decode('utf-8')
+            except UnicodeDecodeError:
+                utf8Names = True
+        subdirs = []
+        for name in names:
+            thispath = path + '/' + name
+            newline = newlineDir or (newlineNames and name.find('\n') != -1)
+            if newline:
+                hits['newline'].append(thispath)
+            utf8 = utf8Dir
+            if utf8Names and not utf8:
+                try:
+                    name.decode('utf-8')
+                except UnicodeDecodeError:
+                    utf8 = True
+            if utf8:
+                hits['utf8'].append(thispath)
+            if thispath.find(d) != -1:
+                hits['destdir'].append(thispath)
+            try:
+                st = os.lstat(d + thispath)
+            except OSError:
+                continue
+            mode = st.st_mode
+            if stat.S_ISDIR(mode):
+                if name == 'lib64':
+                    hits['lib64'].append(thispath)
+                subdirs.append((thispath, newline, utf8))
+            elif stat.S_ISLNK(mode):
+                contents = _readlink(self.recipe, thispath, st)
+                if contents.find(d) != -1 or contents.find(b) != -1:
+                    hits['link'].append(thispath)
+                    self.links[thispath] = contents
+            elif stat.S_ISREG(mode):
+                hits['regular'].append(thispath)
+        for args in subdirs:
+            self._scanDir(*args)
+
+    def getHits(self, rule):
+        if self.hits is None:
+            self._scan()
+        return self.hits[rule]
+
+    def readlink(self, path):
+        return self.links[path]
+
+
+def _getPathLint(recipe):
+    pathLint = getattr(recipe, '_pathLint', None)
+    if pathLint is None:
+        pathLint = _PathLint(recipe)
+        recipe._pathLint = pathLint
+    return pathLint
+
+
+class _pathLint(policy.Policy):
+    """
+    Mixin for policies that check path names rather than file contents.
+    Instead of dispatching C{doFile} on every path, C{lintPaths} takes
+    the paths that break a rule from the shared L{_PathLint} snapshot
+    and applies this policy's filters to those paths only.
+    """
+    def lintPaths(self, rule, skipCapsules=True):
+        return self.lintFilter(_getPathLint(self.recipe).getHits(rule),
+                               skipCapsules=skipCapsules)
+
+    def lintFilter(self, paths, skipCapsules=True):
+        subtrees = getattr(self, 'subtrees', None)
+        if subtrees:
+            # the paths that walking the subtrees would have reached
+            subtrees = [ filter.Filter(*self.filterExpression(
+                            re.escape((x % self.macros).rstrip('/')
+                                      ).replace('%', '%%') + '(/.*)?$'))
+                         for x in subtrees ]
+        capsules = skipCapsules and hasattr(self.recipe,
+                                            '_getCapsulePathsForFile')
+        derived = (self.processUnmodified is False
+                   and hasattr(self.recipe, '_isDerived')
+                   and self.recipe._isDerived == True)
+        for path in paths:
+            if subtrees and not [ x for x in subtrees if x.match(path) ]:
+                continue
+            if capsules and self.recipe._getCapsulePathsForFile(path):
+                continue
+            if (derived and path in self.recipe._derivedFiles
+                and not self.mtimeChanged(path)):
+                # ignore this file
+                continue
+            if not self.policyInclusion(path) or self.policyException(path):
+                continue
+            yield path
+
+
+class BadFilenames(policy.EnforcementPolicy, _pathLint):
     """
     NAME
     ====
@@ -50,18 +203,14 @@ class BadFilenames(policy.EnforcementPolicy):
         assert(not self.exceptions)
         return True
 
-    def doFile(self, path):
+    def do(self):
         # Capsules do not participate in protocols that forbid newlines
         # in file names, such as tag handlers
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
-        if path.find('\n') != -1:
+        for path in self.lintPaths('newline'):
             self.error("path %s has illegal newline character", path)
 
 
-class NonUTF8Filenames(policy.EnforcementPolicy):
+class NonUTF8Filenames(policy.EnforcementPolicy, _pathLint):
     """
     NAME
     ====
@@ -80,13 +229,8 @@ class NonUTF8Filenames(policy.EnforcementPolicy):
     UTF-8, as that is the standard encoding.
     """
     processUnmodified = True
-    def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-        try:
-            path.decode('utf-8')
-        except UnicodeDecodeError:
+    def do(self):
+        for path in self.lintPaths('utf8'):
             self.error('path "%s" is not valid UTF-8', path)
 
 
@@ -164,7 +308,7 @@ class NonMultilibComponent(policy.EnforcementPolicy):
             self.reported[p] = True
 
 
-class NonMultilibDirectories(policy.EnforcementPolicy):
+class NonMultilibDirectories(policy.EnforcementPolicy, _pathLint):
     """
     NAME
     ====
@@ -198,12 +342,13 @@ class NonMultilibDirectories(policy.EnforcementPolicy):
                 return False
         return True
 
-    def doFile(self, path):
-        self.error('path %s has illegal lib64 component on 32-bit platform',
-                   path)
+    def do(self):
+        for path in self.lintPaths('lib64', skipCapsules=False):
+            self.error('path %s has illegal lib64 component on 32-bit'
+                       ' platform', path)
 
 
-class CheckDestDir(policy.EnforcementPolicy):
+class CheckDestDir(policy.EnforcementPolicy, _pathLint):
     """
     NAME
     ====
@@ -228,19 +373,16 @@ class CheckDestDir(policy.EnforcementPolicy):
     does not search inside files.
     """
     processUnmodified = False
-    def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
-
+    def do(self):
         d = self.macros.destdir
         b = self.macros.builddir
 
-        if filename.find(d) != -1:
+        for filename in self.lintPaths('destdir'):
             self.error('Path %s contains destdir %s', filename, d)
-        fullpath = d+filename
-        if os.path.islink(fullpath):
-            contents = os.readlink(fullpath)
+
+        pathLint = _getPathLint(self.recipe)
+        for filename in self.lintPaths('link'):
+            contents = pathLint.readlink(filename)
             if contents.find(d) != -1:
                 self.error('Symlink %s contains destdir %s in contents %s',
                            filename, d, contents)
@@ -249,14 +391,22 @@ class CheckDestDir(policy.EnforcementPolicy):
                            filename, b, contents)
 
         badRPATHS = (d, b, '/tmp', '/var/tmp')
-        m = self.recipe.magic[filename]
-        if m and m.name == "ELF":
+        illegal = []
+        for filename in pathLint.getHits('regular'):
+            m = self.recipe.magic[filename]
+            if not (m and m.name == "ELF"):
+                continue
             rpaths = m.contents['RPATH'] or ''
             for rpath in rpaths.split(':'):
                 for badRPATH in badRPATHS:
                     if rpath.startswith(badRPATH):
-                        self.error('file %s has illegal RPATH %s', filename, rpath)
+                        illegal.append((filename, rpath))
                         break
+        if illegal:
+            checked = set(self.lintFilter(set(x[0] for x in illegal)))
+            for filename, rpath in illegal:
+                if filename in checked:
+                    self.error('file %s has illegal RPATH %s', filename, rpath)
 
 
 class FilesForDirectories(policy.EnforcementPolicy):
@@ -411,7 +561,7 @@ class FixObsoletePaths(policy.DestdirPolicy, _pathMap):
                     path, newPath)
 
 
-class NonLSBPaths(policy.EnforcementPolicy, _pathMap):
+class NonLSBPaths(policy.EnforcementPolicy, _pathMap, _pathLint):
     """
     NAME
     ====
@@ -449,16 +599,19 @@ class NonLSBPaths(policy.EnforcementPolicy, _pathMap):
         self.invariantinclusions = self.candidates.keys()
         policy.EnforcementPolicy.doProcess(self, recipe)
 
-    def doFile(self, path):
-        newPath, error, advice = self.candidates[path]
+    def do(self):
+        capsule = False
         if hasattr(self.recipe, '_getCapsulePathsForFile'):
             if self.recipe.getType() == recipe.RECIPE_TYPE_CAPSULE:
-                error = False
-        if error:
-            talk = self.error
-        else:
-            talk = self.warn
-        talk('Found path %s: %s', path, advice)
+                capsule = True
+        found = dict(self.candidatePaths())
+        for path in self.lintFilter(sorted(found), skipCapsules=False):
+            newPath, error, advice = found[path]
+            if error and not capsule:
+                talk = self.error
+            else:
+                talk = self.warn
+            talk('Found path %s: %s', path, advice)
 
 
 class PythonEggs(policy.EnforcementPolicy):
@@ -15,8 +15,10 @@
 #
 
 
+import fnmatch
 import itertools
 import os
+import re
 
 from conary.build import packagepolicy
 from conary.deps import deps
@@ -31,6 +33,46 @@ else:
     # will then be ignored.
     _basePluggableRequires = object
 
+_sectionRe = re.compile(r'^\[\s*([A-Za-z0-9._-]+)\s*\]$')
+_requirementRe = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*'
+    r'(?:\[[A-Za-z0-9._,\s-]*\])?\s*'
+    r'(?:[(<>=!~][<>=!~,.()\sA-Za-z0-9*+_-]*)?$')
+_unsafeNameRe = re.compile('[^A-Za-z0-9.]+')
+
+def _parseRequiresTxt(contents):
+    """
+    Parse the contents of an egg-info requires.txt file, returning
+    a list of mandatory requirement names and a list of requirement
+    names only needed by extras, named as pkg_resources would name
+    them.  Returns None if the file uses syntax (environment markers,
+    URLs, line continuations) that should be left to pkg_resources.
+    """
+    mandatoryReqs = []
+    allReqs = []
+    section = None
+    for line in contents.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if ' #' in line:
+            line = line[:line.find(' #')].rstrip()
+        if line.startswith('['):
+            match = _sectionRe.match(line)
+            if not match:
+                return None
+            section = match.group(1)
+            continue
+        match = _requirementRe.match(line)
+        if not match:
+            return None
+        name = _unsafeNameRe.sub('-', match.group(1))
+        if not section:
+            mandatoryReqs.append(name)
+        allReqs.append(name)
+    optionalReqs = [x for x in allReqs if x not in mandatoryReqs]
+    return mandatoryReqs, optionalReqs
+
 class EggRequires(_basePluggableRequires):
     """
     NAME
@@ -68,10 +110,49 @@ class EggRequires(_basePluggableRequires):
     invariantinclusions = [r'%(libdir)s/python.*\.egg-info/requires.txt',
             r'%(prefix)s/lib/python.*\.egg-info/requires.txt']
 
+    eggInfoPrefixes = [
+        '%(destdir)s%(libdir)s/python*/',
+        '%(destdir)s%(prefix)s/lib/python*/',
+        '%(destdir)s%(libdir)s/python*/site-packages/',
+        '%(destdir)s%(prefix)s/lib/python*/site-packages/',
+        '%(libdir)s/python*/',
+        '%(prefix)s/lib/python*/',
+        '%(libdir)s/python*/site-packages/',
+        '%(prefix)s/lib/python*/site-packages/',
+    ]
+
     def __init__(self, *args, **kw):
         self._checkedForPythonSetupTools = False
+        self.eggInfoIndex = None
+        self.eggInfos = {}
         packagepolicy._basePluggableRequires.__init__(self, *args, **kw)
 
+    def _findEggInfo(self, req, macros):
+        """
+        Return the first PKG-INFO file matching
+        C{<prefix>req*.egg-info/PKG-INFO} for the first of the
+        eggInfoPrefixes that has one, or None.  Each prefix is globbed
+        once, for all requirements.
+        """
+        if self.eggInfoIndex is None:
+            self.eggInfoIndex = [
+                [ (os.path.basename(os.path.dirname(x)), x)
+                  for x in fixedglob.glob(
+                      (prefix + '*.egg-info/PKG-INFO') % macros) ]
+                for prefix in self.eggInfoPrefixes ]
+        if req not in self.eggInfos:
+            found = None
+            pattern = req + '*.egg-info'
+            for eggInfos in self.eggInfoIndex:
+                for eggInfoDir, pkgInfo in eggInfos:
+                    if fnmatch.fnmatchcase(eggInfoDir, pattern):
+                        found = pkgInfo
+                        break
+                if found:
+                    break
+            self.eggInfos[req] = found
+        return self.eggInfos[req]
+
     def _checkForPythonSetupTools(self, fullpath):
         self.transitiveBuildRequires = self.recipe._getTransitiveBuildRequiresNames()
         if 'python-setuptools:python' not in self.transitiveBuildRequires:
@@ -91,6 +172,14 @@ class EggRequires(_basePluggableRequires):
         return True
 
     def _parseEggRequires(self, path, fullpath):
+        f = open(fullpath)
+        try:
+            reqs = _parseRequiresTxt(f.read())
+        finally:
+            f.close()
+        if reqs is not None:
+            return reqs
+
         if not self._checkedForPythonSetupTools:
             if not self._checkForPythonSetupTools(path):
                 try:
@@ -122,22 +211,9 @@ class EggRequires(_basePluggableRequires):
         mandatoryReqs, optionalReqs = self._parseEggRequires(path, fullpath)
         filesRequired = []
         for req in itertools.chain(mandatoryReqs, optionalReqs):
-            candidatePrefs = [
-                '%(destdir)s%(libdir)s/python*/',
-                '%(destdir)s%(prefix)s/lib/python*/',
-                '%(destdir)s%(libdir)s/python*/site-packages/',
-                '%(destdir)s%(prefix)s/lib/python*/site-packages/',
-                '%(libdir)s/python*/',
-                '%(prefix)s/lib/python*/',
-                '%(libdir)s/python*/site-packages/',
-                '%(prefix)s/lib/python*/site-packages/',
-                    ]
-            candidateFileNames = [(x + req + '*.egg-info/PKG-INFO') % macros \
-                    for x in candidatePrefs]
-            candidateFiles = [fixedglob.glob(x) for x in candidateFileNames]
-            candidateFiles = [x[0] for x in candidateFiles if x]
-            if candidateFiles:
-                filesRequired.append(candidateFiles[0])
+            eggInfo = self._findEggInfo(req, macros)
+            if eggInfo:
+                filesRequired.append(eggInfo)
             else:
                 if req in mandatoryReqs:
                     self.warn('Python egg-info for %s was not found', req)
@@ -27,6 +27,18 @@ from conary.build import policy
 from conary.build import use
 
 
+# reads the ownership snapshot shared by resolvefiledeps.py
+def _troveNamesByPath(recipe, db, path):
+    """
+    Return the names of the troves in the local database that own
+    C{path}, through the path ownership snapshot of
+    ResolveFileDependencies when it is loaded.
+    """
+    if hasattr(recipe, '_troveNamesByPath'):
+        return recipe._troveNamesByPath(db, path)
+    return [ x.getName() for x in db.iterTrovesByPath(path) ]
+
+
 def _providesNames(libname):
     provideList = [libname]
     if libname.endswith(':lib') or libname.endswith(':devellib'):
@@ -290,8 +302,8 @@ class _enforceBuildRequirements(_warnBuildRequirements):
         if interpreterSet:
             # find their components and add them to the list
             for interpreter in interpreterSet:
-                for trove in self.db.iterTrovesByPath(interpreter):
-                    interpreterTroveName = trove.getName()
+                for interpreterTroveName in _troveNamesByPath(
+                        self.recipe, self.db, interpreter):
                     if interpreterTroveName not in self.transitiveBuildRequires:
                         self.talk('interpreter %s missing build requirement %s',
                                   interpreter, interpreterTroveName)
@@ -685,8 +697,7 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
         # transitive closure of runtime requirements of buildRequires
         fileReqs = set()
         for path in sorted(self.foundPaths):
-            for pathReq in set(trove.getName()
-                               for trove in db.iterTrovesByPath(path)):
+            for pathReq in set(_troveNamesByPath(self.recipe, db, path)):
                 pathReqCandidates = _providesNames(pathReq)
                 # remove any recursive or non-existing buildreqs
                 pathReqCandidates = [x for x in pathReqCandidates 
@@ -947,8 +958,8 @@ class EnforceFlagBuildRequirements(_warnBuildRequirements):
                             if flag.name in dep[1].flags:
                                 continue
             path = flag._path
-            for trove in self.db.iterTrovesByPath(path):
-                flagTroveName = trove.getName()
+            for flagTroveName in _troveNamesByPath(self.recipe, self.db,
+                                                   path):
                 if flagTroveName in self.transitiveBuildRequires:
                     foundBuildRequires.add(flagTroveName)
                 else:
@@ -1106,8 +1117,8 @@ class EnforceStaticLibBuildRequirements(_warnBuildRequirements):
         def pathSetToTroveSet(pathSet):
             troveSet = set()
             for path in pathSet:
-                for pathReq in set(trove.getName()
-                                   for trove in db.iterTrovesByPath(path)):
+                for pathReq in set(_troveNamesByPath(self.recipe, db,
+                                                     path)):
                     pathReqCandidates = _providesNames(pathReq)
                     # remove any recursive or non-existing buildreqs
                     pathReqCandidates = [x for x in pathReqCandidates 
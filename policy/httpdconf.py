@@ -25,6 +25,21 @@ else:
     # will then be ignored.
     _basePluggableRequires = object
 
+# copied from badfilecontents.py
+def _strippedLines(path):
+    """
+    Yield the non-blank lines of the file at path, stripped of leading
+    and trailing whitespace, reading only as far as the caller iterates.
+    """
+    f = file(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        f.close()
+
 class HttpdConfigRequires(_basePluggableRequires):
     """
     NAME
@@ -73,9 +88,10 @@ class HttpdConfigRequires(_basePluggableRequires):
         # test stripped lines to ignore all leading and trailing whitespace
         # so that indented comments and lines with only whitespace are
         # not counted as having configuration information in them
-        conflines = [y for y in (x.strip() for x in file(fullpath).readlines())
-                     if y and not y.startswith('#')]
-        if not conflines:
+        for line in _strippedLines(fullpath):
+            if not line.startswith('#'):
+                break
+        else:
             # All lines are blank or commented
             return
 
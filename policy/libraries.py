@@ -15,10 +15,11 @@
 #
 
 
+import mmap
 import os
 import stat
 
-from conary.lib import util
+from conary.lib import magic, util
 from conary.build import policy, recipe
 from conary.local import database
 
@@ -38,6 +39,194 @@ librarydirs = [
     '%(prefix)s/local/lib/',
 ]
 
+def _libcmp(p1, p2):
+    """
+    Compare library file names the way ldconfig does (glibc
+    C{_dl_cache_libcmp}): runs of digits compare numerically and sort
+    after anything else.
+    """
+    i = j = 0
+    while i < len(p1):
+        if p1[i].isdigit():
+            if j < len(p2) and p2[j].isdigit():
+                k = i
+                while k < len(p1) and p1[k].isdigit():
+                    k += 1
+                l = j
+                while l < len(p2) and p2[l].isdigit():
+                    l += 1
+                val = cmp(int(p1[i:k]), int(p2[j:l]))
+                if val:
+                    return val
+                i, j = k, l
+            else:
+                return 1
+        elif j < len(p2) and p2[j].isdigit():
+            return -1
+        elif j >= len(p2) or p1[i] != p2[j]:
+            return cmp(p1[i:i+1], p2[j:j+1])
+        else:
+            i += 1
+            j += 1
+    return cmp('', p2[j:j+1])
+
+
+class _LibraryInventory(object):
+    """
+    Cook-wide inventory of destdir library directories, shared by the
+    library policies so that each entry is lstat()ed once.  Each
+    directory is listed (non-recursively) the first time any path in it
+    is queried, recording the lstat mode and symlink target of every
+    entry; ELF soname and abi come from the recipe's magic cache.  The
+    inventory is not revalidated against the filesystem: every policy
+    that creates, removes, moves or chmods files that may be in a
+    library directory must call the update methods of the inventory
+    stored on the recipe, if there is one.
+    """
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.destdir = recipe.macros.destdir
+        # dir -> {name: [st_mode, linkTarget]}
+        self.dirs = {}
+
+    def _getDir(self, dirName):
+        entries = self.dirs.get(dirName)
+        if entries is not None:
+            return entries
+        fullDir = self.destdir + dirName
+        entries = {}
+        if os.path.isdir(fullDir):
+            for name in os.listdir(fullDir):
+                entry = self._lstat('/'.join((fullDir, name)))
+                if entry is not None:
+                    entries[name] = entry
+        self.dirs[dirName] = entries
+        return entries
+
+    def _lstat(self, fullPath):
+        try:
+            mode = os.lstat(fullPath).st_mode
+        except OSError:
+            return None
+        target = None
+        if stat.S_ISLNK(mode):
+            target = os.readlink(fullPath)
+        return [mode, target]
+
+    def lookup(self, path):
+        path = util.normpath(path)
+        return self._getDir(os.path.dirname(path)).get(
+            os.path.basename(path))
+
+    def getMode(self, path):
+        entry = self.lookup(path)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def isRegular(self, path):
+        entry = self.lookup(path)
+        return entry is not None and stat.S_ISREG(entry[0])
+
+    def isLink(self, path):
+        entry = self.lookup(path)
+        return entry is not None and stat.S_ISLNK(entry[0])
+
+    def readlink(self, path):
+        """
+        Return the contents of the symlink path, or None if path does
+        not exist or is not a symlink
+        """
+        entry = self.lookup(path)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def exists(self, path):
+        """
+        Like os.path.exists, follows symlinks.
+        """
+        entry = self.lookup(path)
+        if entry is None:
+            return False
+        if stat.S_ISLNK(entry[0]):
+            return os.path.exists(self.destdir + path)
+        return True
+
+    def getMagic(self, path):
+        """
+        Returns the magic of path, whose contents include the ELF
+        soname and abi
+        """
+        return self.recipe.magic[path]
+
+    def setMode(self, path, mode):
+        entry = self.lookup(path)
+        if entry is not None:
+            entry[0] = stat.S_IFMT(entry[0]) | mode
+
+    def update(self, path):
+        """
+        Re-record path after it has been created, replaced or removed
+        """
+        path = util.normpath(path)
+        dirName = os.path.dirname(path)
+        if dirName not in self.dirs:
+            return
+        entries = self.dirs[dirName]
+        entry = self._lstat(self.destdir + path)
+        if entry is None:
+            entries.pop(os.path.basename(path), None)
+        else:
+            entries[os.path.basename(path)] = entry
+
+    def move(self, src, dest):
+        self.update(src)
+        self.update(dest)
+
+    def invalidate(self, dirName):
+        self.dirs.pop(util.normpath(dirName), None)
+
+
+def _getLibraryInventory(recipe):
+    inventory = getattr(recipe, '_libraryInventory', None)
+    if inventory is None:
+        inventory = _LibraryInventory(recipe)
+        recipe._libraryInventory = inventory
+    return inventory
+
+
+# copied from phprequires.py
+def _fileContains(path, marker):
+    """
+    Return True if the file at path contains marker, searching it
+    through a read-only memory map rather than reading it.
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return False
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        return data.find(marker) != -1
+    finally:
+        data.close()
+
+
+# reads the ownership snapshot shared by resolvefiledeps.py
+def _troveNamesByPath(recipe, db, path):
+    """
+    Return the names of the troves in the local database that own
+    C{path}, through the path ownership snapshot of
+    ResolveFileDependencies when it is loaded.
+    """
+    if hasattr(recipe, '_troveNamesByPath'):
+        return recipe._troveNamesByPath(db, path)
+    return [ x.getName() for x in db.iterTrovesByPath(path) ]
+
+
 class AutoSharedLibrary(policy.DestdirPolicy):
     """
     NAME
@@ -74,7 +263,7 @@ class AutoSharedLibrary(policy.DestdirPolicy):
 
     def _managedFile(self, path):
         db = database.Database(self.recipe.cfg.root, self.recipe.cfg.dbPath)
-        return bool(db.iterTrovesByPath(path))
+        return bool(_troveNamesByPath(self.recipe, db, path))
 
     def _iterSharedlibList(self):
         destdir = self.recipe.macros.destdir
@@ -157,7 +346,7 @@ class WarnScriptSharedLibrary(policy.EnforcementPolicy):
     def doFile(self, path):
         fullpath = self.rootdir + path
         relpath = path[1:]
-        if 'ld.so.conf' in file(fullpath, 'r').read():
+        if _fileContains(fullpath, 'ld.so.conf'):
             self.error('Capsule script %s mentions ld.so.conf\n'
                        'Directories containing shared libraries:'
                        " r.SharedLibrary(subtrees='/path/to/directory')\n"
@@ -241,9 +430,9 @@ class SharedLibrary(policy.PackagePolicy):
             if self.recipe._getCapsulePathsForFile(filename):
                 return
 
-        fullpath = self.macros.destdir + filename
-        if os.path.isfile(fullpath) and util.isregular(fullpath):
-            m = self.recipe.magic[filename]
+        inventory = _getLibraryInventory(self.recipe)
+        if inventory.isRegular(filename):
+            m = inventory.getMagic(filename)
             if m and m.name == 'ELF' and 'soname' in m.contents:
                 self.info(filename)
                 self.recipe.autopkg.pathMap[filename].tags.set("shlib")
@@ -302,16 +491,21 @@ class FixupMultilibPaths(policy.DestdirPolicy):
             self.dirmap[d %self.macros] = self.dirmap[d] %self.macros
         return True
 
+    def preProcess(self):
+        # (path, target, new symlink contents or None to rename)
+        self.relocations = []
+        self.targets = set()
+        self.conflicts = []
+
     def doFile(self, path):
         if hasattr(self.recipe, '_getCapsulePathsForFile'):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        destdir = self.macros.destdir
-        fullpath = util.joinPaths(destdir, path)
-        mode = os.lstat(fullpath)[stat.ST_MODE]
-        m = self.recipe.magic[path]
-        if stat.S_ISREG(mode) and (
+        inventory = _getLibraryInventory(self.recipe)
+        isReg = inventory.isRegular(path)
+        m = inventory.getMagic(path)
+        if isReg and (
             not m or (m.name != "ELF" and m.name != "ar")):
             self.warn("non-object file with library name %s", path)
             return
@@ -323,11 +517,13 @@ class FixupMultilibPaths(policy.DestdirPolicy):
         # we still need to add the /subdir/
         targetdir += os.path.dirname(path[len(currentsubtree):])
         target = util.joinPaths(targetdir, basename)
-        fulltarget = util.joinPaths(destdir, target)
-        if os.path.exists(fulltarget):
-            tmode = os.lstat(fulltarget)[stat.ST_MODE]
-            tm = self.recipe.magic[target]
-            if (not stat.S_ISREG(mode) or not stat.S_ISREG(tmode)):
+        if target in self.targets:
+            self.conflicts.append("Conflicting library files %s and %s"
+                                  " installed" %(path, target))
+            return
+        if inventory.exists(target):
+            tm = inventory.getMagic(target)
+            if (not isReg or not inventory.isRegular(target)):
                 # one or both might be symlinks, in which case we do
                 # not want to touch this
                 return
@@ -338,61 +534,81 @@ class FixupMultilibPaths(policy.DestdirPolicy):
                 # that properly contains both lib and lib64 items,
                 # and we shouldn't try to fix them.
                 return
-            raise policy.PolicyError(
-                "Conflicting library files %s and %s installed" %(
-                    path, target))
-        self.warn('file %s found in wrong directory, attempting to fix...',
-                  path)
-        util.mkdirChain(destdir + targetdir)
-        if stat.S_ISREG(mode):
-            util.rename(destdir + path, fulltarget)
-            try:
-                self.recipe.recordMove(destdir + path, fulltarget)
-            except AttributeError:
-                pass
-        else:
+            self.conflicts.append("Conflicting library files %s and %s"
+                                  " installed" %(path, target))
+            return
+
+        contents = None
+        if not isReg:
             # we should have a symlink that may need the contents changed
-            contents = os.readlink(fullpath)
+            contents = inventory.readlink(path)
+            if contents is None:
+                # neither a regular file nor a symlink
+                return
             if contents.find('/') == -1:
                 # simply rename
-                util.rename(destdir + path, destdir + target)
-                try:
-                    self.recipe.recordMove(destdir + path, fulltarget)
-                except AttributeError:
-                    pass
+                contents = None
             else:
                 # need to change the contents of the symlink to point to
                 # the new location of the real file
-                contentdir = os.path.dirname(contents)
-                contenttarget = os.path.basename(contents)
-                olddir = os.path.dirname(path)
-                if contentdir.startswith('/'):
-                    # absolute path
-                    if contentdir == olddir:
-                        # no need for a path at all, change to local relative
-                        os.symlink(contenttarget, destdir + target)
-                        os.remove(fullpath)
-                        return
-                if not contentdir.startswith('.'):
-                    raise policy.PolicyError(
-                        'Multilib: cannot fix relative path %s in %s -> %s\n'
-                        'Library files should be in %s'
-                        %(contentdir, path, contents, targetdir))
-                # now deal with ..
-                # first, check for relative path that resolves to same dir
-                i = contentdir.find(olddir)
-                if i != -1:
-                    dotlist = contentdir[:i].split('/')
-                    dirlist = contentdir[i+1:].split('/')
-                    if len(dotlist) == len(dirlist):
-                        # no need for a path at all, change to local relative
-                        os.symlink(contenttarget, destdir + target)
-                        os.remove(fullpath)
-                        return
-                raise policy.PolicyError(
-                        'Multilib: cannot fix relative path %s in %s -> %s\n'
-                        'Library files should be in %s'
-                        %(contentdir, path, contents, targetdir))
+                contents = self._relink(path, contents, targetdir)
+                if contents is None:
+                    return
+        self.targets.add(target)
+        self.relocations.append((path, target, contents))
+
+    def _relink(self, path, contents, targetdir):
+        contentdir = os.path.dirname(contents)
+        contenttarget = os.path.basename(contents)
+        olddir = os.path.dirname(path)
+        if contentdir.startswith('/'):
+            # absolute path
+            if contentdir == olddir:
+                # no need for a path at all, change to local relative
+                return contenttarget
+        if contentdir.startswith('.'):
+            # now deal with ..
+            # first, check for relative path that resolves to same dir
+            i = contentdir.find(olddir)
+            if i != -1:
+                dotlist = contentdir[:i].split('/')
+                dirlist = contentdir[i+1:].split('/')
+                if len(dotlist) == len(dirlist):
+                    # no need for a path at all, change to local relative
+                    return contenttarget
+        self.conflicts.append(
+            'Multilib: cannot fix relative path %s in %s -> %s\n'
+            'Library files should be in %s'
+            %(contentdir, path, contents, targetdir))
+        return None
+
+    def postProcess(self):
+        if self.conflicts:
+            raise policy.PolicyError('\n'.join(self.conflicts))
+        if not self.relocations:
+            return
+
+        destdir = self.macros.destdir
+        inventory = _getLibraryInventory(self.recipe)
+        for targetdir in sorted(set(os.path.dirname(x[1])
+                                    for x in self.relocations)):
+            util.mkdirChain(destdir + targetdir)
+        moves = []
+        for path, target, contents in self.relocations:
+            self.warn('file %s found in wrong directory, attempting to fix...',
+                      path)
+            if contents is None:
+                util.rename(destdir + path, destdir + target)
+                moves.append((destdir + path, destdir + target))
+            else:
+                os.symlink(contents, destdir + target)
+                os.remove(destdir + path)
+            inventory.move(path, target)
+        try:
+            for src, dest in moves:
+                self.recipe.recordMove(src, dest)
+        except AttributeError:
+            pass
 
 
 class ExecutableLibraries(policy.DestdirPolicy):
@@ -432,15 +648,16 @@ class ExecutableLibraries(policy.DestdirPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        fullpath = util.joinPaths(self.macros['destdir'], path)
-        if not util.isregular(fullpath):
+        inventory = _getLibraryInventory(self.recipe)
+        if not inventory.isRegular(path):
             return
-        mode = os.lstat(fullpath)[stat.ST_MODE]
+        mode = inventory.getMode(path)
         if mode & 0111:
             # has some executable bit set
             return
         self.warn('non-executable library %s, changing to mode 0755', path)
-        os.chmod(fullpath, 0755)
+        os.chmod(util.joinPaths(self.macros['destdir'], path), 0755)
+        inventory.setMode(path, 0755)
 
 
 class CheckSonames(policy.EnforcementPolicy):
@@ -488,11 +705,9 @@ class CheckSonames(policy.EnforcementPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        d = self.macros.destdir
-        destlen = len(d)
-        l = util.joinPaths(d, path)
-        if not os.path.islink(l):
-            m = self.recipe.magic[path]
+        inventory = _getLibraryInventory(self.recipe)
+        if not inventory.isLink(path):
+            m = inventory.getMagic(path)
             if m and m.name == 'ELF' and 'soname' in m.contents:
                 if os.path.basename(path) == m.contents['soname']:
                     target = m.contents['soname']+'.something'
@@ -504,36 +719,31 @@ class CheckSonames(policy.EnforcementPolicy):
             return
 
         # store initial contents
-        sopath = util.joinPaths(os.path.dirname(l), os.readlink(l))
+        sopath = util.joinPaths(os.path.dirname(path), inventory.readlink(path))
         so = util.normpath(sopath)
         # find final file
-        while os.path.islink(l):
-            l = util.normpath(util.joinPaths(os.path.dirname(l),
-                                             os.readlink(l)))
+        linkpath = path
+        while inventory.isLink(linkpath):
+            linkpath = util.normpath(util.joinPaths(os.path.dirname(linkpath),
+                                                    inventory.readlink(linkpath)))
 
-        p = util.joinPaths(d, path)
-        linkpath = l[destlen:]
-        m = self.recipe.magic[linkpath]
+        m = inventory.getMagic(linkpath)
 
         if m and m.name == 'ELF' and 'soname' in m.contents:
             if so == linkpath:
                 self.info('%s is final path, soname is %s;'
                     ' soname usually is symlink to specific implementation',
                     linkpath, m.contents['soname'])
-            soname = util.normpath(util.joinPaths(
+            s = util.normpath(util.joinPaths(
                         os.path.dirname(sopath), m.contents['soname']))
-            s = soname[destlen:]
-            try:
-                os.stat(soname)
-                if not os.path.islink(soname) and s not in self.nonSymlinkWarn:
+            # the missing file case will be fixed up by other policy
+            if inventory.exists(s):
+                if not inventory.isLink(s) and s not in self.nonSymlinkWarn:
                     self.nonSymlinkWarn.add(s)
                     self.info('%s has soname %s; best practice is that the'
                               ' filename that matches the soname is a symlink:'
                               ' soname -> soname.minorversion',
                               s, m.contents['soname'])
-            except OSError:
-                # the missing file case will be fixed up by other policy
-                pass
 
 
 class NormalizeLibrarySymlinks(policy.DestdirPolicy):
@@ -572,11 +782,14 @@ class NormalizeLibrarySymlinks(policy.DestdirPolicy):
             if self.recipe.getType() == recipe.RECIPE_TYPE_CAPSULE:
                 return
         macros = self.macros
-        subtrees = self.invariantsubtrees
+        subtrees = list(self.invariantsubtrees)
         if self.subtrees:
             subtrees.extend(self.subtrees)
+        paths = []
         for path in subtrees:
             path = util.normpath(path % macros)
+            if path in paths:
+                continue
             fullpath = '/'.join((self.macros.destdir, path))
             if not os.path.exists(fullpath):
                 continue
@@ -587,39 +800,146 @@ class NormalizeLibrarySymlinks(policy.DestdirPolicy):
                 self.error('The subtrees= argument takes directories only;'
                            ' %s is not a directory', path)
                 continue
-            oldfiles = set(os.listdir(fullpath))
-            bootStrapLdConfig = True
-            ldConfigPath = '%(destdir)s%(essentialsbindir)s/ldconfig'%macros
-            if (not os.path.exists(ldConfigPath)) or self.recipe.isCrossCompiling():
-                bootStrapLdConfig = False
-                ldConfigPath = '%(essentialsbindir)s/ldconfig'%macros
-            if not os.path.exists(ldConfigPath):
-                self.warn('ldconfig not found')
-                continue
-            util.execute('%s -n %s' %(ldConfigPath, fullpath))
-
-            if not bootStrapLdConfig:
-                db = database.Database(self.recipe.cfg.root,
-                                       self.recipe.cfg.dbPath)
-                ldConfigTroveName = [ x.getName() for x in
-                                      db.iterTrovesByPath(ldConfigPath) ]
-                if ldConfigTroveName:
-                    ldConfigTroveName = ldConfigTroveName[0]
-                else:
-                    ldConfigTroveName = 'glibc:runtime'
+            paths.append(path)
 
+        if self.recipe.isCrossCompiling():
+            # the libraries are for the target; let its ldconfig decide
+            self._runLdconfig(paths)
+            return
+        self.realDestdir = os.path.realpath(self.macros.destdir)
+        for path in paths:
+            self._linkSonames(path)
+
+    def _getSoname(self, realFile, name):
+        """
+        Return the soname that ldconfig would use for realFile, found
+        in the directory as name, or None if it is not an ELF file.
+        """
+        if realFile.startswith(self.realDestdir + '/'):
+            m = self.recipe.magic[realFile[len(self.realDestdir):]]
+        else:
+            m = magic.magic(realFile)
+        if not m or m.name != 'ELF':
+            return None
+        return m.contents.get('soname', name)
+
+    def _linkSonames(self, path):
+        """
+        Create the soname symlinks that C{ldconfig -n} would create in
+        the destdir directory path.
+        """
+        fullpath = '/'.join((self.macros.destdir, path))
+        # soname -> [name, isLink]
+        dlibs = {}
+        for name in sorted(os.listdir(fullpath)):
+            if (not (name.startswith('lib') or name.startswith('ld-'))
+                or '.so' not in name):
+                continue
+            entry = '/'.join((fullpath, name))
+            st = os.lstat(entry)
+            isLink = stat.S_ISLNK(st.st_mode)
+            realFile = entry
+            if isLink:
+                realFile = os.path.realpath(entry)
                 try:
-                    if ldConfigTroveName in self.recipe._getTransitiveBuildRequiresNames():
-                        self.recipe.reportExcessBuildRequires(ldConfigTroveName)
-                    else:
-                        self.recipe.reportMissingBuildRequires(ldConfigTroveName)
-                except AttributeError:
-                    # older Conary that does not have
-                    # reportExcessBuildRequires or even the older
-                    # reportMissingBuildRequires or
-                    # _getTransitiveBuildRequiresNames
-                    pass
+                    st = os.stat(realFile)
+                except OSError:
+                    continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            soname = self._getSoname(realFile, name)
+            if soname is None:
+                continue
+            if isLink:
+                # a link is only a link to ldconfig if it is the soname
+                # link or the .so link for ld(1); otherwise it is treated
+                # as a normal file
+                realBase = os.path.basename(realFile)
+                if (realBase != soname and
+                    not (realBase.endswith('.so') and
+                         soname.startswith(realBase))):
+                    isLink = False
+            if isLink:
+                soname = name
+            if soname in dlibs:
+                oldName, oldIsLink = dlibs[soname]
+                # prefer a file to a link, otherwise the newer version
+                if ((oldIsLink and not isLink) or
+                    (oldIsLink == isLink and _libcmp(oldName, name) < 0)):
+                    dlibs[soname] = [name, isLink]
+            else:
+                dlibs[soname] = [name, isLink]
+
+        added = []
+        replaced = []
+        for soname in sorted(dlibs):
+            name, isLink = dlibs[soname]
+            # don't create links to links
+            if isLink or name == soname:
+                continue
+            libPath = '/'.join((fullpath, name))
+            soPath = '/'.join((fullpath, soname))
+            exists = False
+            if os.path.exists(soPath):
+                libStat = os.stat(libPath)
+                soStat = os.stat(soPath)
+                if (libStat.st_dev, libStat.st_ino) == \
+                        (soStat.st_dev, soStat.st_ino):
+                    continue
+                if not os.path.islink(soPath):
+                    self.warn('%s/%s is not a symbolic link', path, soname)
+                    continue
+                exists = True
+            elif os.path.islink(soPath):
+                # stale symlink
+                exists = True
+            if exists:
+                os.remove(soPath)
+                replaced.append(soname)
+            else:
+                added.append(soname)
+            os.symlink(name, soPath)
+            _getLibraryInventory(self.recipe).update('/'.join((path, soname)))
+
+        if added:
+            self.info('added the following new soname symlinks in %s: %s',
+                      path, ', '.join(added))
+        if replaced:
+            self.info('replaced the following soname symlinks in %s: %s',
+                      path, ', '.join(replaced))
+
+    def _runLdconfig(self, paths):
+        macros = self.macros
+        ldConfigPath = '%(essentialsbindir)s/ldconfig'%macros
+        if not os.path.exists(ldConfigPath):
+            self.warn('ldconfig not found')
+            return
+
+        db = database.Database(self.recipe.cfg.root,
+                               self.recipe.cfg.dbPath)
+        ldConfigTroveName = _troveNamesByPath(self.recipe, db, ldConfigPath)
+        if ldConfigTroveName:
+            ldConfigTroveName = ldConfigTroveName[0]
+        else:
+            ldConfigTroveName = 'glibc:runtime'
 
+        try:
+            if ldConfigTroveName in self.recipe._getTransitiveBuildRequiresNames():
+                self.recipe.reportExcessBuildRequires(ldConfigTroveName)
+            else:
+                self.recipe.reportMissingBuildRequires(ldConfigTroveName)
+        except AttributeError:
+            # older Conary that does not have
+            # reportExcessBuildRequires or even the older
+            # reportMissingBuildRequires or
+            # _getTransitiveBuildRequiresNames
+            pass
+
+        for path in paths:
+            fullpath = '/'.join((self.macros.destdir, path))
+            oldfiles = set(os.listdir(fullpath))
+            util.execute('%s -n %s' %(ldConfigPath, fullpath))
+            _getLibraryInventory(self.recipe).invalidate(path)
             newfiles = set(os.listdir(fullpath))
             addedfiles = newfiles - oldfiles
             removedfiles = oldfiles - newfiles
@@ -87,3 +87,7 @@ class RemoveNonPackageFiles(policy.DestdirPolicy):
                 return
         self.info("Removing %s", path)
         util.remove(self.macros['destdir']+path, quiet=True)
+        # the library inventory of libraries.py, if taken yet
+        inventory = getattr(self.recipe, '_libraryInventory', None)
+        if inventory is not None:
+            inventory.update(path)
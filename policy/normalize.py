@@ -18,15 +18,31 @@
 import os
 import re
 import stat
+import struct
+import sys
 import tempfile
-import filecmp
+import threading
+import time
 import shutil
+import zipfile
 
-from conary.lib import magic, util
+from conary.lib import sha1helper, util
 from conary.build import policy, recipe
 from conary.local import database
 
 
+# reads the ownership snapshot shared by resolvefiledeps.py
+def _troveNamesByPath(recipe, db, path):
+    """
+    Return the names of the troves in the local database that own
+    C{path}, through the path ownership snapshot of
+    ResolveFileDependencies when it is loaded.
+    """
+    if hasattr(recipe, '_troveNamesByPath'):
+        return recipe._troveNamesByPath(db, path)
+    return [ x.getName() for x in db.iterTrovesByPath(path) ]
+
+
 def _findProgPath(prog, db, recipe):
     # ignore arguments
     prog = prog.split(' ')[0]
@@ -44,7 +60,7 @@ def _findProgPath(prog, db, recipe):
                            if x not in searchPath])
         progPath = util.findFile(prog, searchPath)
 
-    progTroveName =  [ x.getName() for x in db.iterTrovesByPath(progPath) ]
+    progTroveName = _troveNamesByPath(recipe, db, progPath)
     if progTroveName:
         progTroveName = progTroveName[0]
         try:
@@ -59,6 +75,331 @@ def _findProgPath(prog, db, recipe):
     return progPath
 
 
+def _cpuCount():
+    try:
+        return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def _parallelMap(func, items):
+    """
+    Call func on each of items from a pool of worker threads and return
+    the results in the order of items.  Exceptions are re-raised after
+    all items have been processed, first one in item order wins, so that
+    failures are reported deterministically.
+    """
+    items = list(items)
+    workers = min(len(items), _cpuCount())
+    if workers <= 1:
+        return [func(x) for x in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    work = iter(enumerate(items))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                try:
+                    i, item = work.next()
+                except StopIteration:
+                    return
+            finally:
+                lock.release()
+            try:
+                results[i] = func(item)
+            except:
+                errors[i] = sys.exc_info()
+
+    threads = [ threading.Thread(target=worker) for x in range(workers) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for e in errors:
+        if e is not None:
+            raise e[0], e[1], e[2]
+    return results
+
+
+def _mkstemp(path):
+    fd, tmpPath = tempfile.mkstemp('.temp', '', os.path.dirname(path))
+    return os.fdopen(fd, 'wb'), tmpPath
+
+
+def _installFile(tmpPath, path, st, blockSize=1024 * 1024):
+    """
+    Replace path, whose original lstat is st, with the contents of
+    tmpPath, keeping the mode of path.  The replacement is an atomic
+    rename unless path has other hard links, in which case the contents
+    are copied back in place so that the inode stays shared.
+    """
+    mode = stat.S_IMODE(st.st_mode)
+    if st.st_nlink == 1:
+        os.chmod(tmpPath, mode)
+        os.rename(tmpPath, path)
+        return
+    try:
+        # we need to be able to write the file
+        os.chmod(path, mode | 0600)
+        src = file(tmpPath, 'rb')
+        dst = file(path, 'wb')
+        shutil.copyfileobj(src, dst, blockSize)
+        dst.close()
+        src.close()
+    finally:
+        # revert any change to mode
+        os.chmod(path, mode)
+        os.unlink(tmpPath)
+
+
+def _rewriteFirstLine(path, replace, blockSize=1024 * 1024):
+    """
+    Replace the first line of the file at path with replace(oldLine)
+    without reading the rest of the file into memory.  A line of the same
+    length is patched in place; otherwise the remainder is stream-copied
+    after the new line.  Mode, timestamps and hardlinks are preserved.
+    Returns True if the file was modified.
+    """
+    st = os.lstat(path)
+    mode = stat.S_IMODE(st.st_mode)
+    f = file(path, 'rb')
+    try:
+        oldLine = f.readline()
+        newLine = replace(oldLine)
+        if newLine == oldLine:
+            return False
+        if len(newLine) == len(oldLine):
+            # we need to be able to write the file
+            os.chmod(path, mode | 0600)
+            try:
+                out = file(path, 'r+b')
+                out.write(newLine)
+                out.close()
+            finally:
+                # revert any change to mode
+                os.chmod(path, mode)
+        else:
+            out, tmpPath = _mkstemp(path)
+            try:
+                out.write(newLine)
+                shutil.copyfileobj(f, out, blockSize)
+                out.close()
+            except:
+                os.unlink(tmpPath)
+                raise
+            _installFile(tmpPath, path, st, blockSize)
+        os.utime(path, (st.st_atime, st.st_mtime))
+        return True
+    finally:
+        f.close()
+
+
+class _LineRewriter(object):
+    """
+    Line-oriented rewrite engine.  Literal C{(old, new)} replacements are
+    applied to each line first, then C{(regexp, replacement)} substitutions
+    with precompiled regular expressions.  Files are streamed; nothing is
+    written unless a line actually changes, in which case the file is
+    replaced atomically.
+    """
+    def __init__(self, literals=(), regexps=()):
+        self.literals = list(literals)
+        self.regexps = list(regexps)
+
+    def rewriteLine(self, line):
+        for old, new in self.literals:
+            if old in line:
+                line = line.replace(old, new)
+        for regexp, replacement in self.regexps:
+            line = regexp.sub(replacement, line)
+        return line
+
+    def rewrite(self, path, markers=()):
+        """
+        Apply the rules to the file at path.  Returns a tuple of whether
+        the file was modified and the set of markers found in the
+        rewritten contents.
+        """
+        st = os.lstat(path)
+        found = set()
+        out = None
+        offset = 0
+        f = file(path, 'rb')
+        try:
+            for line in f:
+                newLine = self.rewriteLine(line)
+                for marker in markers:
+                    if marker in newLine:
+                        found.add(marker)
+                if out is None:
+                    if newLine == line:
+                        offset += len(line)
+                        continue
+                    # first change; copy the unchanged lines read so far
+                    out, tmpPath = _mkstemp(path)
+                    prefix = file(path, 'rb')
+                    while offset:
+                        buf = prefix.read(min(offset, 1024 * 1024))
+                        if not buf:
+                            break
+                        out.write(buf)
+                        offset -= len(buf)
+                    prefix.close()
+                out.write(newLine)
+        except:
+            f.close()
+            if out is not None:
+                out.close()
+                os.unlink(tmpPath)
+            raise
+        f.close()
+        if out is None:
+            return False, found
+        out.close()
+        _installFile(tmpPath, path, st)
+        return True, found
+
+
+def _zipMemberMtime(info):
+    # prefer the UTC "extended timestamp" extra field, as unzip does
+    extra = info.extra
+    while len(extra) >= 4:
+        tag, size = struct.unpack('<HH', extra[:4])
+        data = extra[4:4 + size]
+        if tag == 0x5455 and len(data) >= 5 and ord(data[0]) & 1:
+            return struct.unpack('<l', data[1:5])[0]
+        extra = extra[4 + size:]
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def _extractZip(zipPath, destDir, umask):
+    """
+    Extract the zip archive at zipPath into the existing directory destDir
+    the way C{unzip -q -o -d destDir zipPath} would: unsafe path components
+    are dropped, modes are taken from archives created on UNIX (without
+    setuid, setgid or sticky bits) and derived from the umask otherwise, symlinks
+    are recreated, and modification times are restored.
+    """
+    zf = zipfile.ZipFile(zipPath)
+    dirTimes = []
+    try:
+        for info in zf.infolist():
+            parts = [ x for x in info.filename.split('/')
+                      if x not in ('', '.', '..') ]
+            if not parts:
+                continue
+            target = os.path.join(destDir, *parts)
+            attr = info.external_attr >> 16
+            isDir = info.filename.endswith('/') or \
+                (info.create_system == 3 and stat.S_ISDIR(attr))
+            if info.create_system == 3 and attr:
+                mode = stat.S_IMODE(attr) & 0777
+            elif isDir:
+                mode = 0777 & ~umask
+            else:
+                mode = 0666 & ~umask
+                if info.external_attr & 0x01:
+                    # MS-DOS read-only
+                    mode &= ~0222
+            mtime = _zipMemberMtime(info)
+
+            if isDir:
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                dirTimes.append((target, mode, mtime))
+                continue
+            parent = os.path.dirname(target)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if os.path.lexists(target):
+                os.unlink(target)
+            if info.create_system == 3 and stat.S_ISLNK(attr):
+                os.symlink(zf.read(info), target)
+                continue
+            src = zf.open(info)
+            dst = file(target, 'wb')
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.close()
+            src.close()
+            os.chmod(target, mode)
+            os.utime(target, (mtime, mtime))
+    finally:
+        zf.close()
+    # directories last, deepest first, so that creating their contents
+    # does not change the restored times
+    for target, mode, mtime in sorted(dirTimes, reverse=True):
+        os.chmod(target, mode)
+        os.utime(target, (mtime, mtime))
+
+
+class _InterpreterPlan(object):
+    """
+    Interpreter line rewrites for scripts in the destdir, collected by an
+    interpreter normalization policy and written out when it finishes, so
+    that each script is rewritten and its magic invalidated at most once
+    per policy.  Lines are kept as in the magic C{line} contents, without
+    the leading C{#!} and trailing newline.
+    """
+    def __init__(self):
+        self.lines = {}
+        self.origLines = {}
+
+    def getLine(self, recipe, path):
+        """
+        Return the current interpreter line for path, or None if path
+        is not a script.
+        """
+        if path in self.lines:
+            return self.lines[path]
+        m = recipe.magic[path]
+        if m and m.name == 'script':
+            return m.contents['line']
+        return None
+
+    def setLine(self, recipe, path, line):
+        if path not in self.origLines:
+            self.origLines[path] = self.getLine(recipe, path)
+        self.lines[path] = line
+
+    def flush(self, recipe):
+        destdir = recipe.macros.destdir
+        for path in sorted(self.lines):
+            oldLine = self.origLines[path]
+            newLine = self.lines[path]
+            if oldLine == newLine:
+                continue
+            # the magic line may be truncated, so substitute into the
+            # first line of the file rather than replacing it
+            _rewriteFirstLine(util.joinPaths(destdir, path),
+                lambda x: x.replace(oldLine, newLine, 1))
+            del recipe.magic[path]
+        self.lines = {}
+        self.origLines = {}
+
+
+# copied from badpathnames.py
+def _readlink(recipe, path, st=None):
+    """
+    Return the contents of the symlink at C{path} in the destdir, or
+    None if C{path} is not a symlink, using the symlink table kept on
+    the recipe by the symlink policies when it exists.
+    """
+    table = getattr(recipe, '_symlinkTable', None)
+    if table is not None:
+        return table.readlink(path, st)
+    fullpath = recipe.macros.destdir + path
+    if st is None:
+        if not os.path.islink(fullpath):
+            return None
+    elif not stat.S_ISLNK(st.st_mode):
+        return None
+    return os.readlink(fullpath)
+
+
 class NormalizeCompression(policy.DestdirPolicy):
     """
     NAME
@@ -190,38 +531,59 @@ class NormalizeManPages(policy.DestdirPolicy):
                                         self.recipe.cfg.dbPath)
         return _findProgPath(prog, self.db, self.recipe)
 
+    def _getProg(self, attr, prog):
+        # only called before or after the worker threads run, since
+        # finding a program may open the local database
+        if not getattr(self, attr):
+            setattr(self, attr, self._findProg(prog))
+        return getattr(self, attr)
+
+    def _hasRegularFile(self, sections, test):
+        for dirname in sections:
+            for name in os.listdir(dirname):
+                if test(name) and util.isregular(dirname + os.sep + name):
+                    return True
+        return False
+
+    def _recordMove(self, src, dest):
+        try:
+            self.recipe.recordMove(src, dest)
+        except AttributeError:
+            pass
+
+    def _replay(self, deferred):
+        # logging and manifest updates are deferred by the worker threads
+        # and replayed here in directory order
+        for func, args in deferred:
+            func(*args)
+
     # Note: not safe for derived packages; needs to check in each
     # internal function for unmodified files
-    def _uncompress(self, dirname, names):
-        for name in names:
+    def _uncompress(self, dirname):
+        deferred = []
+        for name in sorted(os.listdir(dirname)):
             path = dirname + os.sep + name
             if name.endswith('.gz') and util.isregular(path):
-                if not self.gunzip:
-                    self.gunzip = self._findProg('gunzip')
-                util.execute('gunzip ' + dirname + os.sep + name)
-                try:
-                    self.recipe.recordMove(util.joinPaths(dirname, name),
-                            util.joinPaths(dirname, name)[:-3])
-                except AttributeError:
-                    pass
+                util.execute('gunzip ' + path, verbose=False)
+                deferred.append((self._recordMove,
+                    (util.joinPaths(dirname, name),
+                     util.joinPaths(dirname, name)[:-3])))
             if name.endswith('.bz2') and util.isregular(path):
-                if not self.bunzip:
-                    self.bunzip = self._findProg('bunzip2')
-                util.execute('bunzip2 ' + dirname + os.sep + name)
-                try:
-                    self.recipe.recordMove(util.joinPaths(dirname, name),
-                            util.joinPaths(dirname, name)[:-4])
-                except AttributeError:
-                    pass
+                util.execute('bunzip2 ' + path, verbose=False)
+                deferred.append((self._recordMove,
+                    (util.joinPaths(dirname, name),
+                     util.joinPaths(dirname, name)[:-4])))
+        return deferred
 
-    def _touchup(self, dirname, names):
+    def _touchup(self, dirname):
         """
         remove destdir, fix up modes, ensure that it is legal UTF-8
         """
+        deferred = []
         mode = os.lstat(dirname)[stat.ST_MODE]
         if mode & 0777 != 0755:
             os.chmod(dirname, 0755)
-        for name in names:
+        for name in sorted(os.listdir(dirname)):
             path = dirname + os.sep + name
             mode = os.lstat(path)[stat.ST_MODE]
             # avoid things like symlinks
@@ -239,8 +601,8 @@ class NormalizeManPages(policy.DestdirPolicy):
                     data = data.decode('iso-8859-1').encode('utf-8')
                     write = True
                 except:
-                    self.error('unable to decode %s as utf-8 or iso-8859-1',
-                               path)
+                    deferred.append((self.error,
+                        ('unable to decode %s as utf-8 or iso-8859-1', path)))
             if data.find(self.destdir) != -1:
                 write = True
                 # I think this is cheaper than using a regexp
@@ -251,11 +613,15 @@ class NormalizeManPages(policy.DestdirPolicy):
                 f.seek(0)
                 f.truncate(0)
                 f.write(data)
+            f.close()
+        return deferred
 
+    def _expand(self, dirname):
+        return self._uncompress(dirname) + self._touchup(dirname)
 
-    def _sosymlink(self, dirname, names):
+    def _sosymlink(self, dirname):
         section = os.path.basename(dirname)
-        for name in names:
+        for name in sorted(os.listdir(dirname)):
             path = dirname + os.sep + name
             if util.isregular(path):
                 # if only .so, change to symlink
@@ -308,31 +674,43 @@ class NormalizeManPages(policy.DestdirPolicy):
                                 os.remove(path)
                                 os.symlink(target, path)
 
-    def _compress(self, dirname, names):
-        for name in names:
+    def _compress(self, dirname):
+        """
+        Compress the regular files in dirname, returning the deferred
+        manifest updates and the resolved targets of any symlinks, which
+        may live in another section and are compressed afterwards.
+        """
+        deferred = []
+        linkTargets = []
+        for name in sorted(os.listdir(dirname)):
             path = dirname + os.sep + name
-            # Resolve symlinks before comporessing to make sure the target
-            # file gets compressed.
             if os.path.islink(path):
-                path = os.path.realpath(path)
+                linkTargets.append(os.path.realpath(path))
+                continue
+            # Assumed already compressed.
+            if path.endswith('.gz'):
+                continue
+            if util.isregular(path):
+                util.execute(self.gzip + ' -f -n -9 ' + path, verbose=False)
+                deferred.append((self._recordMove, (path, path + '.gz')))
+        return deferred, linkTargets
+
+    def _compressLinkTargets(self, paths):
+        for path in paths:
             # Assumed already compressed.
             if path.endswith('.gz'):
                 continue
-            # Already been compressed via symlink lookup or the dangling
-            # symlink policy will catch it.
+            # Already been compressed as a regular file in its own section
+            # or the dangling symlink policy will catch it.
             if not os.path.exists(path):
                 continue
             if util.isregular(path):
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
+                self._getProg('gzip', 'gzip')
                 util.execute(self.gzip + ' -f -n -9 ' + path)
-                try:
-                    self.recipe.recordMove(path, path + '.gz')
-                except AttributeError:
-                    pass
+                self._recordMove(path, path + '.gz')
 
-    def _gzsymlink(self, dirname, names):
-        for name in names:
+    def _gzsymlink(self, dirname):
+        for name in sorted(os.listdir(dirname)):
             path = dirname + os.sep + name
             if os.path.islink(path):
                 # change symlinks to .gz -> .gz
@@ -360,23 +738,40 @@ class NormalizeManPages(policy.DestdirPolicy):
         return True
 
     def do(self):
+        self.destdir = self.macros['destdir'][1:] # without leading /
         for manpath in sorted(list(set((
                 self.macros.mandir,
                 os.sep.join((self.macros.x11prefix, 'man')),
                 os.sep.join((self.macros.krbprefix, 'man')),)))
             ):
             manpath = self.macros.destdir + manpath
-            self.destdir = self.macros['destdir'][1:] # without leading /
-            # uncompress all man pages
-            os.path.walk(manpath, NormalizeManPages._uncompress, self)
-            # remove '/?%(destdir)s' and fix modes
-            os.path.walk(manpath, NormalizeManPages._touchup, self)
-            # .so foo.n becomes a symlink to foo.n
-            os.path.walk(manpath, NormalizeManPages._sosymlink, self)
+            sections = sorted(x[0] for x in os.walk(manpath))
+            if self._hasRegularFile(sections, lambda x: x.endswith('.gz')):
+                self._getProg('gunzip', 'gunzip')
+            if self._hasRegularFile(sections, lambda x: x.endswith('.bz2')):
+                self._getProg('bunzip', 'bunzip2')
+            # uncompress all man pages, remove '/?%(destdir)s' and fix
+            # modes; each section is independent
+            for deferred in _parallelMap(self._expand, sections):
+                self._replay(deferred)
+            # .so foo.n becomes a symlink to foo.n; this needs the final
+            # uncompressed names in all sections
+            for section in sections:
+                self._sosymlink(section)
             # recompress all man pages
-            os.path.walk(manpath, NormalizeManPages._compress, self)
+            if self._hasRegularFile(sections,
+                                    lambda x: not x.endswith('.gz')):
+                self._getProg('gzip', 'gzip')
+            linkTargets = set()
+            for deferred, targets in _parallelMap(self._compress, sections):
+                self._replay(deferred)
+                linkTargets.update(targets)
+            # Resolve symlinks to make sure their target files get
+            # compressed, including targets outside of the man path
+            self._compressLinkTargets(sorted(linkTargets))
             # change all symlinks to point to .gz (if they don't already)
-            os.path.walk(manpath, NormalizeManPages._gzsymlink, self)
+            for section in sections:
+                self._gzsymlink(section)
 
 
 class NormalizeInfoPages(policy.DestdirPolicy):
@@ -425,9 +820,19 @@ class NormalizeInfoPages(policy.DestdirPolicy):
             infofiles = os.listdir(infofilespath)
             for file in infofiles:
                 self._moveToInfoRoot(file)
-            infofiles = os.listdir(infofilespath)
-            for file in infofiles:
-                self._processInfoFile(file)
+            # decide what to do in this thread, then run the (de)compressors
+            # concurrently and record the results in file order
+            infofiles = sorted(os.listdir(infofilespath))
+            plans = [ x for x in (self._planInfoFile(y) for y in infofiles)
+                      if x is not None ]
+            _parallelMap(self._runInfoPlan, plans)
+            for cmd, path, src, dest in plans:
+                if dest is not None:
+                    try:
+                        self.recipe.recordMove(src, dest)
+                    except AttributeError:
+                        pass
+                del self.recipe.magic[path]
 
     def __init__(self, *args, **keywords):
         policy.DestdirPolicy.__init__(self, *args, **keywords)
@@ -458,45 +863,45 @@ class NormalizeInfoPages(policy.DestdirPolicy):
             except AttributeError:
                 pass
 
-    def _processInfoFile(self, file):
+    def _planInfoFile(self, file):
+        """
+        Return a (command, path, source, destination) tuple describing
+        how to normalize the compression of the info file, or None.
+        The destination is None if the file name does not change.
+        """
         syspath = '%(destdir)s/%(infodir)s/' %self.macros + file
         path = '%(infodir)s/' %self.macros + file
-        if not self.policyException(path):
-            m = self.recipe.magic[path]
-            if not m or m.name not in ('gzip', 'bzip'):
-                # not compressed
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                util.execute('gzip -f -n -9 %s' %syspath)
-                try:
-                    self.recipe.recordMove(syspath, syspath + '.gz')
-                except AttributeError:
-                    pass
-                del self.recipe.magic[path]
-            elif m.name == 'gzip' and \
-                (m.contents['compression'] != '9' or \
-                'name' in m.contents):
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                if not self.gunzip:
-                    self.gunzip = self._findProg('gunzip')
-                util.execute('gunzip %s; gzip -f -n -9 %s'
-                            %(syspath, syspath[:-3]))
-                # filename didn't change, so don't record it in the manifest
-                del self.recipe.magic[path]
-            elif m.name == 'bzip':
-                # should use gzip instead
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                if not self.bunzip:
-                    self.bunzip = self._findProg('bunzip2')
-                util.execute('bunzip2 %s; gzip -f -n -9 %s'
-                            %(syspath, syspath[:-4]))
-                try:
-                    self.recipe.recordMove(syspath, syspath[:-4] + '.gz')
-                except AttributeError:
-                    pass
-                del self.recipe.magic[path]
+        if self.policyException(path):
+            return None
+        m = self.recipe.magic[path]
+        if not m or m.name not in ('gzip', 'bzip'):
+            # not compressed
+            if not self.gzip:
+                self.gzip = self._findProg('gzip')
+            return ('gzip -f -n -9 %s' %syspath, path,
+                    syspath, syspath + '.gz')
+        elif m.name == 'gzip' and \
+            (m.contents['compression'] != '9' or \
+            'name' in m.contents):
+            if not self.gzip:
+                self.gzip = self._findProg('gzip')
+            if not self.gunzip:
+                self.gunzip = self._findProg('gunzip')
+            # filename didn't change, so don't record it in the manifest
+            return ('gunzip %s; gzip -f -n -9 %s' %(syspath, syspath[:-3]),
+                    path, syspath, None)
+        elif m.name == 'bzip':
+            # should use gzip instead
+            if not self.gzip:
+                self.gzip = self._findProg('gzip')
+            if not self.bunzip:
+                self.bunzip = self._findProg('bunzip2')
+            return ('bunzip2 %s; gzip -f -n -9 %s' %(syspath, syspath[:-4]),
+                    path, syspath, syspath[:-4] + '.gz')
+        return None
+
+    def _runInfoPlan(self, plan):
+        util.execute(plan[0], verbose=False)
 
 
 class NormalizeInitscriptLocation(policy.DestdirPolicy):
@@ -598,8 +1003,8 @@ class NormalizeInitscriptContents(policy.DestdirPolicy):
 
         m = self.recipe.macros
         fullpath = '/'.join((m.destdir, path))
-        if os.path.islink(fullpath):
-            linkpath = os.readlink(fullpath)
+        linkpath = _readlink(self.recipe, path)
+        if linkpath is not None:
             if m.destdir not in linkpath:
                 # RelativeSymlinks has already run. linkpath is relative to
                 # fullpath
@@ -613,24 +1018,22 @@ class NormalizeInitscriptContents(policy.DestdirPolicy):
                             (path, linkpath))
                     return
 
-        contents = file(fullpath).read()
-        modified = False
-        if ('/etc/rc.d/init.d' != m.initdir and
-            '/etc/rc.d/init.d' in contents):
-            contents = contents.replace('/etc/rc.d/init.d', m.initdir)
-            modified = True
-        elif ('/etc/init.d' != m.initdir and
-              '/etc/init.d' in contents):
-            contents = contents.replace('/etc/init.d', m.initdir)
-            modified = True
-
-        if '%(initdir)s/functions' %m in contents:
+        # /etc/init.d is only rewritten in scripts that do not refer
+        # to /etc/rc.d/init.d at all
+        functions = '%(initdir)s/functions' %m
+        literals = [ x for x in ('/etc/rc.d/init.d', '/etc/init.d')
+                     if x != m.initdir ]
+        found = _LineRewriter().rewrite(fullpath,
+                                        markers=literals + [functions])[1]
+        rules = [ (x, m.initdir) for x in literals if x in found ][:1]
+        if rules:
+            found = _LineRewriter(literals=rules).rewrite(fullpath,
+                                                          markers=[functions])[1]
+
+        if functions in found:
             self.recipe.Requires('file: %(initdir)s/functions',
                                  util.literalRegex(path))
 
-        if modified:
-            file(fullpath, 'w').write(contents)
-
 
 class NormalizeAppDefaults(policy.DestdirPolicy):
     """
@@ -726,24 +1129,44 @@ class NormalizeInterpreterPaths(policy.DestdirPolicy):
         if not mode & 0111:
             # we care about interpreter paths only in executable scripts
             return
-        m = self.recipe.magic[path]
-        if m and m.name == 'script':
-           
-            if self._correctInterp(m, path):
-                del self.recipe.magic[path]
-                m = self.recipe.magic[path]
-            if self._correctEnv(m, path):
-                del self.recipe.magic[path]
+        plan = self.plan
+        line = plan.getLine(self.recipe, path)
+        if line is not None:
+            newLine = self._correctInterp(line, path)
+            if newLine is not None:
+                line = newLine
+            newLine = self._correctEnv(line, path)
+            if newLine is not None:
+                line = newLine
+            if line != plan.getLine(self.recipe, path):
+                plan.setLine(self.recipe, path, line)
+
+    def postProcess(self):
+        self.plan.flush(self.recipe)
 
-    def _correctInterp(self, m, path):
+    def preProcess(self):
+        # Interpreter resolution depends only on the interpreter named in
+        # the script and on which interpreters exist in the destdir and on
+        # the system.  This policy only rewrites script headers, so
+        # nothing can add an interpreter to the destdir while it runs and
+        # the answers can be shared by all scripts for the whole run.
+        self.interpMemo = {}
+        self.envMemo = {}
+        self.plan = _InterpreterPlan()
+
+    def _resolveInterp(self, interp):
+        """
+        Return a (normalized, missing) tuple for interp, where normalized
+        is the path the interpreter should be changed to, or None, and
+        missing is True if the interpreter could not be found at all.
+        """
         destdir = self.recipe.macros.destdir
-        d = util.joinPaths(destdir, path)
-
-        interp = m.contents['interpreter']
         interpDir = os.path.dirname(interp)
         interpBase = os.path.basename(interp)
 
         found = False
+        missing = False
+        normalized = None
 
         if not os.path.exists('/'.join((destdir, interp))) and not os.path.exists(interp):
             #try tro remove 'local' part
@@ -771,7 +1194,7 @@ class NormalizeInterpreterPaths(policy.DestdirPolicy):
                                 found = True
                                 break
                         if not found:
-                            self.warn('The interpreter path %s in %s does not exist!', interp, path)
+                            missing = True
 
         # If the interp has symlinks along its dir path, rewrite to the real
         # path. Do not rewrite the name of the interpreter itself as that might
@@ -781,59 +1204,59 @@ class NormalizeInterpreterPaths(policy.DestdirPolicy):
             normalized = '/'.join((os.path.realpath(interpDir), interpBase))
             found = True
 
-        if found:
-                line = m.contents['line']
+        if not found:
+            normalized = None
+        return normalized, missing
+
+    def _correctInterp(self, line, path):
+        interp = line.split()[0]
+        if interp not in self.interpMemo:
+            self.interpMemo[interp] = self._resolveInterp(interp)
+        normalized, missing = self.interpMemo[interp]
+
+        if missing:
+            self.warn('The interpreter path %s in %s does not exist!', interp, path)
+
+        if normalized is not None:
                 normalized = line.replace(interp, normalized)
-                self._changeInterpLine(d, '#!' + normalized + '\n')
                 self.info('changing %s to %s in %s',
                             line, normalized, path)
+                return normalized
 
-        return found
-       
-    def _correctEnv(self, m, path):
-        destdir = self.recipe.macros.destdir
-        d = util.joinPaths(destdir, path)
+        return None
 
-        interp = m.contents['interpreter']
+    def _resolveEnv(self, interp):
+        destdir = self.recipe.macros.destdir
+        # first look in package
+        fullintpath = util.checkPath(interp, root=destdir)
+        if fullintpath == None:
+            # then look on installed system
+            fullintpath = util.checkPath(interp)
+        return fullintpath
+
+    def _correctEnv(self, line, path):
+        interp = line.split()[0]
         if interp.find('/bin/env') != -1: #finds /usr/bin/env too...
-            line = m.contents['line']
             # rewrite to not have env
             wordlist = [ x for x in line.split() ]
             if len(wordlist) == 1:
                 self.error("Interpreter is not given for %s in %s", wordlist[0], path)
-                return
+                return None
             wordlist.pop(0) # get rid of env
-            # first look in package
-            fullintpath = util.checkPath(wordlist[0], root=destdir)
-            if fullintpath == None:
-                # then look on installed system
-                fullintpath = util.checkPath(wordlist[0])
+            if wordlist[0] not in self.envMemo:
+                self.envMemo[wordlist[0]] = self._resolveEnv(wordlist[0])
+            fullintpath = self.envMemo[wordlist[0]]
             if fullintpath == None:
                 self.error("Interpreter %s for file %s not found, could not convert from /usr/bin/env syntax", wordlist[0], path)
-                return False
+                return None
 
             wordlist[0] = fullintpath
 
-            self._changeInterpLine(d, '#!'+" ".join(wordlist)+'\n')
             self.info('changing %s to %s in %s',
                         line, " ".join(wordlist), path)
-            return True
-        return False
+            return " ".join(wordlist)
+        return None
 
-    def _changeInterpLine(self, path, newline):
-        mode = os.lstat(path)[stat.ST_MODE]
-        # we need to be able to write the file
-        os.chmod(path, mode | 0600)
-        f = file(path, 'r+')
-        l = f.readlines()
-        l[0] = newline
-        f.seek(0)
-        f.truncate(0)# we may have shrunk the file, avoid garbage
-        f.writelines(l)
-        f.close()
-        # revert any change to mode
-        os.chmod(path, mode)
-       
 
 class NormalizePamConfig(policy.DestdirPolicy):
     """
@@ -872,23 +1295,13 @@ class NormalizePamConfig(policy.DestdirPolicy):
             # we'll process whatever this is pointing to whenever we
             # get there.
             return
-        if not (mode & 0200):
-            os.chmod(d, mode | 0200)
-        f = file(d, 'r+')
-        l = f.readlines()
-        l = [x.replace('/lib/security/$ISA/', '') for x in l]
-        stackRe = re.compile('(.*)required.*pam_stack.so.*service=(.*)')
-        def removeStack(line):
-            m = stackRe.match(line)
-            if m:
-                return '%s include %s\n'%(m.group(1), m.group(2))
-            return line
-        l = [removeStack(x) for x in l]
-        f.seek(0)
-        f.truncate(0) # we may have shrunk the file, avoid garbage
-        f.writelines(l)
-        f.close()
-        os.chmod(d, mode)
+        self.rewriter.rewrite(d)
+
+    def preProcess(self):
+        self.rewriter = _LineRewriter(
+            literals=[('/lib/security/$ISA/', '')],
+            regexps=[(re.compile('(.*)required.*pam_stack.so.*service=(.*)\n?'),
+                      r'\1 include \2\n')])
 
 class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
     """
@@ -946,6 +1359,11 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
     def preProcess(self):
         self.interpreterRe = re.compile(".*python[-0-9.]+$")
         self.interpMap = {}
+        self.dirIndex = {}
+        self.digests = {}
+        self.trovePaths = {}
+        self.db = None
+        self.plan = _InterpreterPlan()
         versionMap = {}
         for item in self.versionMap.items():
             versionMap[item[0]%self.macros] = item[1]%self.macros
@@ -956,12 +1374,10 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        destdir = self.recipe.macros.destdir
-        d = util.joinPaths(destdir, path)
-        mode = os.lstat(d)[stat.ST_MODE]
-        m = self.recipe.magic[path]
-        if m and m.name == 'script':
-            interp = m.contents['interpreter']
+        plan = self.plan
+        line = plan.getLine(self.recipe, path)
+        if line is not None:
+            interp = line.split()[0]
             if '/python' not in interp:
                 # we handle only python scripts here
                 return
@@ -969,77 +1385,101 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
                 normalized = self.versionMap[interp]
             elif not self._isNormalizedInterpreter(interp):
                 # normalization
-                if self.interpMap.has_key(interp):
-                    normalized = self.interpMap[interp]
-                else:
-                    normalized = self._normalize(interp)
-                    if normalized:
-                        self.interpMap[interp] = normalized
-                    else:
-                        self.warn('No version-specific python interpreter '
-                                  'found for %s in %s', interp, path)
-                        return
+                if not self.interpMap.has_key(interp):
+                    self.interpMap[interp] = self._normalize(interp)
+                normalized = self.interpMap[interp]
+                if not normalized:
+                    self.warn('No version-specific python interpreter '
+                              'found for %s in %s', interp, path)
+                    return
             else:
                 return
 
-            # we need to be able to write the file
-            os.chmod(d, mode | 0600)
-            f = file(d, 'r+')
-            l = f.readlines()
-            l[0] = l[0].replace(interp, normalized)
-            # we may have shrunk the file, avoid garbage
-            f.seek(0)
-            f.truncate(0)
-            f.writelines(l)
-            f.close()
-            # revert any change to mode
-            os.chmod(d, mode)
-
+            plan.setLine(self.recipe, path, line.replace(interp, normalized))
             self.info('changed %s to %s in %s', interp, normalized, path)
-            del self.recipe.magic[path]
+
+    def postProcess(self):
+        self.plan.flush(self.recipe)
 
     def _isNormalizedInterpreter(self, interp):
         return os.path.basename(interp).startswith('python') and self.interpreterRe.match(interp)
 
+    def _getDirIndex(self, dirName):
+        """
+        Return (device, inode) -> names and size -> names maps for the
+        entries of dirName, built once per directory.
+        """
+        if dirName not in self.dirIndex:
+            byInode = {}
+            bySize = {}
+            for name in sorted(os.listdir(dirName)):
+                try:
+                    st = os.stat('/'.join((dirName, name)))
+                except OSError:
+                    # dangling symlink
+                    continue
+                byInode.setdefault((st.st_dev, st.st_ino), []).append(name)
+                if stat.S_ISREG(st.st_mode):
+                    bySize.setdefault(st.st_size, []).append(name)
+            self.dirIndex[dirName] = (byInode, bySize)
+        return self.dirIndex[dirName]
+
+    def _getDigest(self, path):
+        if path not in self.digests:
+            try:
+                self.digests[path] = sha1helper.sha1FileBin(path)
+            except (IOError, OSError):
+                # this is a fallback for a bad install anyway, so
+                # a failure here is both unusual and not important
+                self.digests[path] = None
+        return self.digests[path]
+
+    def _getTrovePaths(self, trove):
+        key = trove.getNameVersionFlavor()
+        if key not in self.trovePaths:
+            self.trovePaths[key] = [x[1] for x in trove.iterFileList()
+                                    if '/python' in x[1]]
+        return self.trovePaths[key]
+
+    def _longest(self, links):
+        path = sorted(links, key=len, reverse=True)
+        if path:
+            return path[0]
+        return None
+
     def _normalize(self, interp):
         dir = self.recipe.macros.destdir
        
         interpFull = '/'.join((dir, interp))
-        interpFullBase = os.path.basename(interpFull)
         interpFullDir = os.path.dirname(interpFull)
         interpDir = os.path.dirname(interp)
 
-        links = []
         if os.path.exists(interpFull):
-            for i in os.listdir(interpFullDir):
-                if os.path.samefile(interpFull, '/'.join((interpFullDir, i))):
-                    links += [i]
-            path = sorted(links, key=len, reverse=True)
-            if path and self._isNormalizedInterpreter('/'.join((interpFullDir, path[0]))):
-                return os.path.join(interpDir, path[0])
-       
-            links = []
-            for i in os.listdir(interpFullDir):
-                try:
-                    if filecmp.cmp(interpFull, '/'.join((interpFullDir, i))):
-                        links += [i]
-                except IOError:
-                    # this is a fallback for a bad install anyway, so
-                    # a failure here is both unusual and not important
-                    pass
-            path = sorted(links, key=len, reverse=True)
-            if path and self._isNormalizedInterpreter('/'.join((interpFullDir, path[0]))):
-                return os.path.join(interpDir, path[0])
+            byInode, bySize = self._getDirIndex(interpFullDir)
+            st = os.stat(interpFull)
+            path = self._longest(byInode.get((st.st_dev, st.st_ino), []))
+            if path and self._isNormalizedInterpreter('/'.join((interpFullDir, path))):
+                return os.path.join(interpDir, path)
+
+            # only files of the same size can have the same contents
+            digest = self._getDigest(interpFull)
+            links = [ x for x in bySize.get(st.st_size, [])
+                      if digest is not None and
+                         self._getDigest('/'.join((interpFullDir, x))) == digest ]
+            path = self._longest(links)
+            if path and self._isNormalizedInterpreter('/'.join((interpFullDir, path))):
+                return os.path.join(interpDir, path)
         
         else:
-            db = database.Database('/', self.recipe.cfg.dbPath)
-            pythonTroveList = db.iterTrovesByPath(interp)
-            for trove in pythonTroveList:
-                pathList = [x[1] for x in trove.iterFileList()]
-                links += [x for x in pathList if x.startswith(interp)]
-            path = sorted(links, key=len, reverse=True)
-            if path and self._isNormalizedInterpreter(path[0]):
-                return path[0]
+            if self.db is None:
+                self.db = database.Database('/', self.recipe.cfg.dbPath)
+            links = []
+            for trove in self.db.iterTrovesByPath(interp):
+                links += [x for x in self._getTrovePaths(trove)
+                          if x.startswith(interp)]
+            path = self._longest(links)
+            if path and self._isNormalizedInterpreter(path):
+                return path
 
         return None
 
@@ -1057,18 +1497,35 @@ class NormalizePythonEggs(policy.DestdirPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        dir = self.recipe.macros.destdir
-        fullPath = util.joinPaths(dir, path)
-        m = magic.magic(fullPath)
+        m = self.recipe.magic[path]
         if not (m and m.name == 'ZIP'):
             # if it's not a zip, we can't unpack it, PythonEggs will raise
             # an error on this path
             return
-        tmpPath = tempfile.mkdtemp(dir = self.recipe.macros.builddir)
-        util.execute("unzip -q -o -d '%s' '%s'" % (tmpPath, fullPath))
-        self._addActionPathBuildRequires(['unzip'])
+        self.eggs.append(path)
+
+    def preProcess(self):
+        self.eggs = []
+        # unzip honors the umask for archives not created on UNIX
+        self.umask = os.umask(022)
+        os.umask(self.umask)
+
+    def postProcess(self):
+        _parallelMap(self._expandEgg, self.eggs)
+        for path in self.eggs:
+            del self.recipe.magic[path]
+
+    def _expandEgg(self, path):
+        fullPath = util.joinPaths(self.recipe.macros.destdir, path)
+        # extract next to the egg so that the final step is a rename
+        tmpPath = tempfile.mkdtemp(dir=os.path.dirname(fullPath))
+        try:
+            _extractZip(fullPath, tmpPath, self.umask)
+        except:
+            shutil.rmtree(tmpPath)
+            raise
         os.unlink(fullPath)
-        shutil.move(tmpPath, fullPath)
+        os.rename(tmpPath, fullPath)
 
 
 # Note: NormalizeLibrarySymlinks is in libraries.py
@@ -22,6 +22,36 @@ from conary.lib import util
 from conary.build import policy
 
 
+class _FileModes(object):
+    """
+    Modes of the files in the destdir, from one lstat per path shared
+    through the recipe by the enforcement policies that check file
+    permissions.  It is only used after the destdir has been packaged;
+    policies that change modes after that must call C{setMode}.
+    """
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.modes = {}
+
+    def getMode(self, path):
+        mode = self.modes.get(path)
+        if mode is None:
+            mode = os.lstat(self.destdir + path)[stat.ST_MODE]
+            self.modes[path] = mode
+        return mode
+
+    def setMode(self, path, mode):
+        self.modes[path] = mode
+
+
+def _getFileModes(recipe):
+    fileModes = getattr(recipe, '_fileModes', None)
+    if fileModes is None:
+        fileModes = _FileModes(recipe.macros.destdir)
+        recipe._fileModes = fileModes
+    return fileModes
+
+
 class ReadableDocs(policy.DestdirPolicy):
     """
     NAME
@@ -63,6 +93,9 @@ class ReadableDocs(policy.DestdirPolicy):
             self.warn('documentation file %s not group and world readable,'
                       ' changing to mode 0%o', path, mode & 07777)
             os.chmod(fullpath, mode)
+            fileModes = getattr(self.recipe, '_fileModes', None)
+            if fileModes is not None:
+                fileModes.setMode(path, mode)
 
 
 class WarnWriteable(policy.EnforcementPolicy):
@@ -100,14 +133,14 @@ class WarnWriteable(policy.EnforcementPolicy):
             if self.recipe._getCapsulePathsForFile(filename):
                 return
 
-        fullpath = self.macros.destdir + filename
-        if os.path.islink(fullpath):
-            return
-        if filename not in self.recipe.autopkg.pathMap:
+        pathMap = self.recipe.autopkg.pathMap
+        if filename not in pathMap:
             # directory has been deleted
             return
-        mode = os.lstat(fullpath)[stat.ST_MODE]
-        group = self.recipe.autopkg.pathMap[filename].inode.group()
+        mode = _getFileModes(self.recipe).getMode(filename)
+        if stat.S_ISLNK(mode):
+            return
+        group = pathMap[filename].inode.group()
         if mode & 02 or (mode & 020 and group != 'root'):
             if stat.S_ISDIR(mode):
                 type = "directory"
@@ -147,8 +180,7 @@ class WorldWriteableExecutables(policy.EnforcementPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        d = self.macros['destdir']
-        mode = os.lstat(util.joinPaths(d, path))[stat.ST_MODE]
+        mode = _getFileModes(self.recipe).getMode(path)
         if mode & 0111 and mode & 02 and not stat.S_ISLNK(mode):
             self.error(
                 "%s has executable mode 0%o with world-writeable permission",
@@ -186,11 +218,10 @@ class IgnoredSetuid(policy.EnforcementPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        fullpath = self.macros.destdir + path
-        mode = os.lstat(fullpath)[stat.ST_MODE]
         pathMap = self.recipe.autopkg.pathMap
         if path not in pathMap:
             return
+        mode = _getFileModes(self.recipe).getMode(path)
         if mode & 06000 and not pathMap[path].inode.perms() & 06000:
             if stat.S_ISDIR(mode):
                 type = "directory"
@@ -17,6 +17,7 @@
 
 import errno
 import itertools
+import mmap
 import os
 
 from conary.build import packagepolicy
@@ -32,6 +33,47 @@ else:
     # will then be ignored.
     _basePluggableRequires = object
 
+def _fileContains(path, marker):
+    """
+    Return True if the file at path contains marker, searching it
+    through a read-only memory map rather than reading it.
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return False
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        return data.find(marker) != -1
+    finally:
+        data.close()
+
+
+# reads the ownership snapshot shared by resolvefiledeps.py
+def _troveNamesByPath(recipe, db, path):
+    """
+    Return the names of the troves in the local database that own
+    C{path}, through the path ownership snapshot of
+    ResolveFileDependencies when it is loaded.
+    """
+    if hasattr(recipe, '_troveNamesByPath'):
+        return recipe._troveNamesByPath(db, path)
+    return [ x.getName() for x in db.iterTrovesByPath(path) ]
+
+
+def _pathHashes(pathHashes, paths):
+    """
+    Return the path hashes, as stored in C{pathHashes} trove info,
+    of each of C{paths}.
+    """
+    hashes = pathHashes.__class__()
+    for path in paths:
+        hashes.addPath(path)
+    return hashes
+
+
 class PHPRequires(_basePluggableRequires):
     """
     NAME
@@ -80,25 +122,13 @@ class PHPRequires(_basePluggableRequires):
 
     def _isPHPFile(self, fullPath):
         # confirm identity of a PHP file by the presence of the <?php marker
-        marker = '<?php'
         try:
-            f = open(fullPath)
+            return _fileContains(fullPath, '<?php')
         except IOError, err:
             if err.errno == errno.ENOENT:
                 # No such file, probably because it is a dead symlink.
                 return False
             raise
-        f.seek(0, 2)
-        limit = f.tell()
-        f.seek(0)
-        buf = f.read(4096)
-        while True:
-            if marker in buf:
-                return True
-            if f.tell() == limit:
-                return False
-            # add the last 5 chars to the end to ensure we don't break a marker
-            buf = buf[-5:] + f.read(4096)
 
     def _getPHPPathCandidateList(self):
         phpBinNames = ('php', 'php5')
@@ -115,9 +145,9 @@ class PHPRequires(_basePluggableRequires):
                                self.cfg.dbPath)
         for phpPath in self.phpPathList:
             # first, do a direct check of the filesystem.
-            if db.pathIsOwned(phpPath):
-                troveList = db.iterTrovesByPath(phpPath)
-                return troveList[0].getName()
+            troveNames = _troveNamesByPath(self.recipe, db, phpPath)
+            if troveNames:
+                return troveNames[0]
 
     def _checkBuildRequires(self, path):
         # then check the buildReqs. we'll drill down to specific files
@@ -127,32 +157,112 @@ class PHPRequires(_basePluggableRequires):
         # php5:lib is the correct trove to require
         pkgNames = [ x.split(':')[0] for x in self.recipe.buildRequires ]
 
+        # the answer depends only on the buildRequires, the
+        # installLabelPath and the flavor, so when the repository cache
+        # is enabled it is remembered between cooks
+        label = ' '.join(str(x) for x in self.cfg.installLabelPath)
+        key = '\0'.join([ str(self.cfg.buildFlavor) ] + self.phpPathList
+                        + sorted(set(pkgNames)))
+        phpTrove = None
+        cache = self._getRepositoryCache()
+        if cache is not None:
+            cached = cache.lookup('phpBuildRequires', label, key)
+            if cached:
+                phpTrove = cached[0]
+        if phpTrove is None:
+            phpTrove = self._findBuildRequiresPHP(pkgNames)
+            if phpTrove is not None and cache is not None:
+                cache.store('phpBuildRequires', label, key, [ phpTrove ])
+        return phpTrove and phpTrove[0] or None
+
+    def _findBuildRequiresPHP(self, pkgNames):
+        """
+        Return the (name, version, flavor) of the first component of
+        the packages in pkgNames that contains one of the PHP paths,
+        or None.
+        """
         troveDict = self.repos.findTroves(
             self.cfg.installLabelPath,
             [ (x, None, self.cfg.buildFlavor) for x in pkgNames ],
             allowMissing = True
         )
 
-        trvs = self.repos.getTroves(list(itertools.chain(*troveDict.values())))
+        trvs = self.repos.getTroves(list(itertools.chain(*troveDict.values())),
+                                    withFiles = False)
         trvs = dict([ (x.getName(), x) for x in trvs ])
 
+        # fetch the components of all the packages at once, without
+        # their file lists
+        compRefs = []
         for pkgName in pkgNames:
             pkgTrv = trvs.get(pkgName)
             if not pkgTrv:
                 continue
-
-            for pkgComp in self.repos.getTroves(list(pkgTrv.iterTroveList(
-                    strongRefs = True, weakRefs = True))):
-                if [ x[1] for x in pkgComp.iterFileList()
-                          if x[1] in self.phpPathList ]:
-                    return pkgComp.getName()
+            compRefs.extend(pkgTrv.iterTroveList(strongRefs = True,
+                                                 weakRefs = True))
+        if not compRefs:
+            return None
+        comps = self.repos.getTroves(compRefs, withFiles = False)
+
+        # use the path hashes, where the components have them, to only
+        # fetch the file lists of components that may contain php
+        phpHashes = None
+        candidates = []
+        for ref, comp in itertools.izip(compRefs, comps):
+            if comp is None:
+                continue
+            pathHashes = getattr(comp.troveInfo, 'pathHashes', None)
+            if pathHashes and hasattr(pathHashes, 'addPath'):
+                if phpHashes is None:
+                    phpHashes = _pathHashes(pathHashes, self.phpPathList)
+                if not [ x for x in phpHashes if x in pathHashes ]:
+                    continue
+            if ref not in candidates:
+                candidates.append(ref)
+        if not candidates:
+            return None
+
+        phpPaths = set(self.phpPathList)
+        for pkgComp in self.repos.getTroves(candidates, withFiles = True):
+            for x in pkgComp.iterFileList():
+                if x[1] in phpPaths:
+                    return (pkgComp.getName(), pkgComp.getVersion(),
+                            pkgComp.getFlavor())
+        return None
+
+    def _getRepositoryCache(self):
+        """
+        Return the repository query cache shared by
+        ResolveFileDependencies, or None if it is not enabled.
+        """
+        if hasattr(self.recipe, '_getRepositoryCache'):
+            return self.recipe._getRepositoryCache(self)
+        return None
+
+    def _labelQueries(self, query):
+        """
+        Yield query(repos, label) for the labels of the installLabelPath
+        in order, concurrently when ResolveFileDependencies has shared
+        its query helpers.
+        """
+        labels = self.cfg.installLabelPath
+        if hasattr(self.recipe, '_labelQueries'):
+            return self.recipe._labelQueries(labels, query)
+        return (query(self.repos, x) for x in labels)
 
     def _checkRepository(self, path):
         # nothing in buildRequires specifies any particular php
         # package.
         # last resort: check for php on the installLabelPath from the repo
-        for lbl in self.cfg.installLabelPath:
-            pathDict = self.repos.getTroveLeavesByPath(self.phpPathList, lbl)
+        phpPathList = self.phpPathList
+        cache = self._getRepositoryCache()
+        if cache is not None:
+            query = lambda repos, lbl: cache.getTroveLeavesByPath(
+                repos, phpPathList, lbl)
+        else:
+            query = lambda repos, lbl: repos.getTroveLeavesByPath(
+                phpPathList, lbl)
+        for pathDict in self._labelQueries(query):
             for phpPath in self.phpPathList:
                 # find the first trove on the installLabelPath that
                 # provides a path to php. warn on multiple matches.
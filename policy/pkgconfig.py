@@ -79,6 +79,94 @@ class NormalizePkgConfig(policy.DestdirPolicy):
             except AttributeError:
                 pass
 
+_variableRe = re.compile(r'\$\{([a-zA-Z0-9]+)\}')
+
+def _expandVariables(line, variables, seen=()):
+    """
+    Replace each C{${name}} in C{line} with the value of the variable
+    C{name}, expanding references within that value in turn.  Unknown
+    and self-referencing variables are left as they are.
+    """
+    def expand(match):
+        name = match.group(1)
+        if name not in variables or name in seen:
+            return match.group(0)
+        return _expandVariables(variables[name], variables, seen + (name,))
+    return _variableRe.sub(expand, line)
+
+
+class _PkgConfigIndex(object):
+    """
+    Cook-wide index of the pkg-config files and libraries referenced
+    from pkg-config files, so that each is looked up once per cook from
+    a single listing of each candidate directory.
+    """
+    def __init__(self, macros):
+        self.macros = macros
+        self.listings = {}
+        self.modules = {}
+        self.libraries = {}
+        self.realDestdir = util.normpath(os.path.realpath(macros.destdir))
+
+    def _exists(self, dirName, name):
+        if '/' in name:
+            return util.exists(dirName + '/' + name)
+        if dirName not in self.listings:
+            try:
+                self.listings[dirName] = set(os.listdir(dirName or '/'))
+            except OSError:
+                self.listings[dirName] = frozenset()
+        return name in self.listings[dirName]
+
+    def findModule(self, req):
+        """
+        Return the path of the pkg-config file for C{req}, looking in
+        the destdir before the system, or None if there is none.
+        """
+        if req not in self.modules:
+            found = None
+            for dirName in ('%(destdir)s%(libdir)s/pkgconfig',
+                            '%(destdir)s%(datadir)s/pkgconfig',
+                            '%(libdir)s/pkgconfig',
+                            '%(datadir)s/pkgconfig'):
+                dirName = dirName % self.macros
+                if self._exists(dirName, req + '.pc'):
+                    found = dirName + '/' + req + '.pc'
+                    break
+            self.modules[req] = found
+        return self.modules[req]
+
+    def findLibrary(self, library, libraryPaths):
+        """
+        Return the path of the shared or static library C{library} in
+        the first of C{libraryPaths} that has it, looking in the destdir
+        before the system, or None if there is none.
+        """
+        for libDir in libraryPaths:
+            key = (libDir, library)
+            if key not in self.libraries:
+                found = None
+                for dirName in (self.macros.destdir + libDir, libDir):
+                    for name in ('lib%s.so' % library, 'lib%s.a' % library):
+                        if self._exists(dirName, name):
+                            found = dirName + '/' + name
+                            break
+                    if found:
+                        break
+                self.libraries[key] = found
+            if self.libraries[key]:
+                return self.libraries[key]
+        return None
+
+
+def _getPkgConfigIndex(recipe):
+    index = getattr(recipe, '_pkgConfigIndex', None)
+    if index is None:
+        index = _PkgConfigIndex(recipe.macros)
+        recipe._pkgConfigIndex = index
+    return index
+
+
 if hasattr(packagepolicy, '_basePluggableRequires'):
     _basePluggableRequires = packagepolicy._basePluggableRequires
 else:
@@ -141,18 +229,12 @@ class PkgConfigRequires(_basePluggableRequires):
         for pcLine in pcContents:
             # interpolate variables: assume variables are interpreted
             # line-by-line while processing
-            pcLineIter = pcLine
-            while True:
-                for var in variables:
-                    pcLineIter = pcLineIter.replace(var, variables[var])
-                if pcLine == pcLineIter:
-                    break
-                pcLine = pcLineIter
-            pcLine = pcLineIter
+            if '${' in pcLine:
+                pcLine = _expandVariables(pcLine, variables)
 
             if variableLineRe.match(pcLine):
                 key, val = pcLine.split('=', 1)
-                variables['${%s}' %key] = val
+                variables[key] = val
             else:
                 if (pcLine.startswith('Requires') or
                     pcLine.startswith('Lib')) and ':' in pcLine:
@@ -180,19 +262,13 @@ class PkgConfigRequires(_basePluggableRequires):
                             else:
                                 pass
 
+        index = _getPkgConfigIndex(self.recipe)
+
         # find referenced pkgconfig files and add requirements
         for req in requirements:
-            candidateFileNames = [
-                '%(destdir)s%(libdir)s/pkgconfig/'+req+'.pc',
-                '%(destdir)s%(datadir)s/pkgconfig/'+req+'.pc',
-                '%(libdir)s/pkgconfig/'+req+'.pc',
-                '%(datadir)s/pkgconfig/'+req+'.pc',
-            ]
-            candidateFileNames = [ x % macros for x in candidateFileNames ]
-            candidateFiles = [ util.exists(x) for x in candidateFileNames ]
-            if True in candidateFiles:
-                filesRequired.append(
-                    (candidateFileNames[candidateFiles.index(True)], 'pkg-config'))
+            fileRequired = index.findModule(req)
+            if fileRequired:
+                filesRequired.append((fileRequired, 'pkg-config'))
             else:
                 self.warn('pkg-config file %s.pc not found', req)
                 continue
@@ -203,22 +279,10 @@ class PkgConfigRequires(_basePluggableRequires):
             if libDir not in libraryPaths:
                 libraryPaths.append(libDir)
         for library in libraries:
-            found = False
-            for libDir in libraryPaths:
-                candidateFileNames = [
-                    macros.destdir+libDir+'/lib'+library+'.so',
-                    macros.destdir+libDir+'/lib'+library+'.a',
-                    libDir+'/lib'+library+'.so',
-                    libDir+'/lib'+library+'.a',
-                ]
-                candidateFiles = [ util.exists(x) for x in candidateFileNames ]
-                if True in candidateFiles:
-                    filesRequired.append(
-                        (candidateFileNames[candidateFiles.index(True)], 'library'))
-                    found = True
-                    break
-
-            if not found:
+            fileRequired = index.findLibrary(library, libraryPaths)
+            if fileRequired:
+                filesRequired.append((fileRequired, 'library'))
+            else:
                 self.warn('library file lib%s not found', library)
                 continue
 
@@ -227,7 +291,7 @@ class PkgConfigRequires(_basePluggableRequires):
             if fileRequired.startswith(macros.destdir):
                 # find requirement in packaging
                 fileRequired = util.normpath(os.path.realpath(fileRequired))
-                fileRequired = fileRequired[len(util.normpath(os.path.realpath(macros.destdir))):]
+                fileRequired = fileRequired[len(index.realDestdir):]
                 autopkg = self.recipe.autopkg
                 troveName = autopkg.componentMap[fileRequired].name
                 package, component = troveName.split(':', 1)
@@ -16,10 +16,548 @@
 
 
 import itertools
+import json
+import mmap
+import os
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 
+from conary import conaryclient, versions
 from conary.build import policy, use
 from conary.deps import deps
+from conary.lib import sha1helper, util
+
+
+class _RepositoryPool(object):
+    """
+    Repository clients for issuing queries concurrently.  Conary's
+    repository client and its proxy and connection caches are not
+    thread-safe, so each query thread is handed a client of its own,
+    created from the build configuration.  The recipe's own client is
+    never handed out, since the policies keep using it while queries
+    are running.  Idle clients are kept for later queries in the cook.
+    """
+    def __init__(self, recipe):
+        self.cfg = recipe.cfg
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()
+        finally:
+            self.lock.release()
+        return conaryclient.ConaryClient(self.cfg).getRepos()
+
+    def release(self, repos):
+        self.lock.acquire()
+        try:
+            self.idle.append(repos)
+        finally:
+            self.lock.release()
+
+
+def _getRepositoryPool(recipe):
+    pool = getattr(recipe, '_repositoryPool', None)
+    if pool is None:
+        pool = _RepositoryPool(recipe)
+        recipe._repositoryPool = pool
+    return pool
+
+
+def _labelQueries(recipe, labels, query):
+    """
+    Call query(repos, label) for every label at once, each with its own
+    repository client, and yield the results in label order.  A caller
+    that stops at the first useful answer gets the same answer as when
+    querying the labels in turn; an exception is raised when the result
+    of the label that raised it is reached.  Outstanding queries are
+    waited for when the caller stops iterating, so that none of them
+    outlives the generator.
+    """
+    labels = list(labels)
+    pool = _getRepositoryPool(recipe)
+    results = [ None ] * len(labels)
+
+    def run(i):
+        try:
+            repos = pool.acquire()
+            try:
+                results[i] = (True, query(repos, labels[i]))
+            finally:
+                pool.release(repos)
+        except Exception:
+            results[i] = (False, sys.exc_info())
+
+    threads = []
+    try:
+        for i in range(len(labels)):
+            t = threading.Thread(target=run, args=(i,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for i, t in enumerate(threads):
+            t.join()
+            ok, result = results[i]
+            if not ok:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        for t in threads:
+            t.join()
+
+
+def _shareRepositoryHelpers(recipe):
+    """
+    Make the installLabelPath query helpers and the path ownership
+    snapshot available through the recipe to the policies in other
+    modules, which cannot import this one.  The contract is:
+
+     - C{recipe._labelQueries(labels, query)} is L{_labelQueries}
+     - C{recipe._getRepositoryCache(pol)} is L{_getRepositoryCache}
+     - C{recipe._troveNamesByPath(db, path)} is L{_troveNamesByPath}
+
+    They are set when ResolveFileDependencies is instantiated, which
+    happens when the recipe loads its policies, before any policy runs.
+    Readers must therefore look them up with C{hasattr} when they run,
+    not when they are instantiated, and must fall back to querying the
+    repository or database directly when they are missing, as they are
+    with older Conary or when this policy is not loaded.
+    """
+    recipe._labelQueries = lambda labels, query: _labelQueries(
+        recipe, labels, query)
+    recipe._getRepositoryCache = _getRepositoryCache
+    recipe._troveNamesByPath = lambda db, path: _troveNamesByPath(
+        recipe, db, path)
+
+
+class _RepositoryCache(object):
+    """
+    Opt-in SQLite cache of installLabelPath query results, shared by
+    concurrent cooks on a build node.  Enabled by setting the
+    C{repositoryquerycache} macro to the path of the cache file;
+    C{repositoryquerycachettl} (seconds, default one day) and
+    C{repositoryquerycachesize} (entries, default 100000) bound it.
+    Only positive answers are kept, so that troves committed to a label
+    later are found at once.  Any problem with the cache file falls
+    back to querying the repository.
+    """
+    def __init__(self, path, ttl, size):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        if os.path.dirname(path):
+            util.mkdirChain(os.path.dirname(path))
+        db = self._connect()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS queries ('
+                       ' kind TEXT, label TEXT, item TEXT,'
+                       ' result TEXT, stamp REAL,'
+                       ' PRIMARY KEY (kind, label, item))')
+            db.execute('CREATE INDEX IF NOT EXISTS queriesStamp'
+                       ' ON queries (stamp)')
+            db.commit()
+        finally:
+            db.close()
+
+    def _connect(self):
+        # one connection per operation, since queries for different
+        # labels run in different threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _lookup(self, kind, label, items):
+        found = {}
+        try:
+            db = self._connect()
+            try:
+                oldest = time.time() - self.ttl
+                for item in items:
+                    row = db.execute('SELECT result FROM queries'
+                                     ' WHERE kind=? AND label=? AND item=?'
+                                     ' AND stamp>?',
+                                     (kind, label, item, oldest)).fetchone()
+                    troveList = row and json.loads(row[0])
+                    if troveList:
+                        found[item] = [ (str(n), versions.ThawVersion(str(v)),
+                                         deps.ThawFlavor(str(f)))
+                                        for n, v, f in troveList ]
+            finally:
+                db.close()
+        except Exception:
+            # unreadable or damaged cache; ask the repository instead
+            return {}
+        return found
+
+    def _store(self, kind, label, results):
+        now = time.time()
+        rows = [ (kind, label, item,
+                  json.dumps([ (n, v.freeze(), f.freeze())
+                               for n, v, f in troveList ]), now)
+                 for item, troveList in results.iteritems() if troveList ]
+        if not rows:
+            return
+        try:
+            db = self._connect()
+            try:
+                db.executemany('INSERT OR REPLACE INTO queries'
+                               ' VALUES (?, ?, ?, ?, ?)', rows)
+                db.execute('DELETE FROM queries WHERE stamp<?',
+                           (now - self.ttl,))
+                count = db.execute('SELECT COUNT(*) FROM queries'
+                                   ).fetchone()[0]
+                if count > self.size:
+                    # evict the oldest entries
+                    db.execute('DELETE FROM queries WHERE rowid IN'
+                               ' (SELECT rowid FROM queries'
+                               '  ORDER BY stamp LIMIT ?)',
+                               (count - self.size,))
+                db.commit()
+            finally:
+                db.close()
+        except sqlite3.Error:
+            pass
+
+    def lookup(self, kind, label, item):
+        """
+        Return the list of (name, version, flavor) tuples cached for
+        C{item} among the C{kind} queries on C{label}, or None.
+        """
+        return self._lookup(kind, str(label), [ item ]).get(item)
+
+    def store(self, kind, label, item, troveList):
+        """
+        Cache the list of (name, version, flavor) tuples found for
+        C{item} by a C{kind} query on C{label}.
+        """
+        self._store(kind, str(label), { item: troveList })
+
+    def resolveDependencies(self, repos, label, depSets):
+        """
+        C{repos.resolveDependencies(label, depSets, leavesOnly=True)},
+        answered from the cache where possible.
+        """
+        depSets = dict((x.freeze(), x) for x in depSets)
+        cached = self._lookup('resolveDependencies', str(label), depSets)
+        solMap = dict((depSets[x], [ cached[x] ]) for x in cached
+                      if cached[x])
+        missing = [ depSets[x] for x in depSets if x not in cached ]
+        if missing:
+            result = repos.resolveDependencies(label, missing,
+                                               leavesOnly=True)
+            results = {}
+            for depSet in missing:
+                solList = result.get(depSet)
+                if solList:
+                    solMap[depSet] = solList
+                results[depSet.freeze()] = list(
+                    itertools.chain(*(solList or [])))
+            self._store('resolveDependencies', str(label), results)
+        return solMap
+
+    def getTroveLeavesByPath(self, repos, paths, label):
+        """
+        C{repos.getTroveLeavesByPath(paths, label)}, answered from the
+        cache where possible.
+        """
+        pathDict = self._lookup('getTroveLeavesByPath', str(label), paths)
+        missing = [ x for x in paths if x not in pathDict ]
+        if missing:
+            result = repos.getTroveLeavesByPath(missing, label)
+            results = dict((x, result.get(x) or []) for x in missing)
+            pathDict.update(results)
+            self._store('getTroveLeavesByPath', str(label), results)
+        return pathDict
+
+
+def _getRepositoryCache(pol):
+    """
+    Return the repository query cache configured by the
+    C{repositoryquerycache} macro, or None if it is not enabled.
+    Problems with the configuration are reported through the policy
+    C{pol} that first asks for the cache.
+    """
+    recipe = pol.recipe
+    cache = getattr(recipe, '_repositoryCache', None)
+    if cache is None:
+        cache = False
+        macros = recipe.macros
+        try:
+            path = macros['repositoryquerycache']
+        except KeyError:
+            path = None
+        if path:
+            limits = []
+            for macro, default in (('repositoryquerycachettl', 24 * 60 * 60),
+                                   ('repositoryquerycachesize', 100000)):
+                try:
+                    limits.append(int(macros[macro]))
+                except KeyError:
+                    limits.append(default)
+                except ValueError:
+                    pol.warn('%s macro is not an integer: %r; using %d',
+                             macro, macros[macro], default)
+                    limits.append(default)
+            ttl, size = limits
+            try:
+                cache = _RepositoryCache(path, ttl, size)
+            except (sqlite3.Error, OSError), e:
+                pol.warn('not using repository query cache %s: %s', path, e)
+                cache = False
+        recipe._repositoryCache = cache
+    return cache or None
+
+
+def _dbOwners(db, path):
+    """
+    Return a list of (trove name, provides path) for the troves in the
+    local database that own C{path}, in database order.
+    """
+    depSet = deps.DependencySet()
+    depSet.addDep(deps.FileDependencies, deps.Dependency(path))
+    return [ (x.getName(), bool(x.provides().satisfies(depSet)))
+             for x in db.iterTrovesByPath(path) ]
+
+
+class _OwnershipSnapshot(object):
+    """
+    Answers of the local database to path ownership queries, kept
+    between cooks in the directory named by the C{pathownershipsnapshot}
+    macro for as long as the database is unchanged.  Each path maps to
+    the troves that own it, in the order C{db.iterTrovesByPath} returns
+    them, and whether each provides the path as a file dependency.
+
+    The snapshot is an answer cache filled lazily, not a copy of the
+    database: paths not yet in it are looked up in the database, so the
+    first cook after the database changes still makes every query.  Each
+    new answer is appended at once to a journal next to the snapshot,
+    whichever policy asked for it, and the journal is merged into the
+    sorted snapshot when the next cook loads it.  Answers appended by
+    another cook while the journal is being merged may be lost, which
+    only costs a database query later.  A sample of the recorded answers
+    is checked against the database before the snapshot is first used.
+    """
+    checkCount = 8
+    version = 'owners-1'
+
+    def __init__(self, path, marker):
+        self.path = path
+        self.journalPath = path + '.log'
+        self.header = '%s %s' % (self.version, marker)
+        self.data = ''
+        self.start = 0
+        self.added = {}
+        self.checked = False
+        self.error = None
+        try:
+            self._merge()
+        except EnvironmentError:
+            pass
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        end = data.find('\n')
+        if end == -1 or data[:end] != self.header:
+            data.close()
+            return
+        self.data = data
+        self.start = end + 1
+
+    def _merge(self):
+        """
+        Merge the answers in the journal that were recorded for the
+        current database into the snapshot, and remove the journal.
+        """
+        try:
+            f = open(self.journalPath, 'rb')
+        except IOError:
+            return
+        lines = {}
+        try:
+            for record in f:
+                if not record.endswith('\n'):
+                    continue
+                header, sep, line = record.partition('\0\0')
+                if sep and header == self.header:
+                    lines[line.split('\0', 1)[0].rstrip('\n')] = line
+        finally:
+            f.close()
+        if lines:
+            try:
+                f = open(self.path, 'rb')
+            except IOError:
+                f = None
+            if f is not None:
+                try:
+                    if f.readline().rstrip('\n') == self.header:
+                        for line in f:
+                            path = line.split('\0', 1)[0].rstrip('\n')
+                            lines.setdefault(path, line)
+                finally:
+                    f.close()
+            dirName = os.path.dirname(self.path)
+            fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.snapshot')
+            try:
+                f = os.fdopen(fd, 'w')
+                try:
+                    f.write(self.header + '\n')
+                    for path in sorted(lines):
+                        f.write(lines[path])
+                finally:
+                    f.close()
+                os.chmod(tmpPath, 0644)
+                os.rename(tmpPath, self.path)
+            except:
+                util.removeIfExists(tmpPath)
+                raise
+        util.removeIfExists(self.journalPath)
+
+    def _line(self, start):
+        end = self.data.find('\n', start)
+        fields = self.data[start:end].split('\0')
+        return end, fields[0], [ (x[1:], x[0] == '+') for x in fields[1:] ]
+
+    def _find(self, path):
+        data = self.data
+        lo = self.start
+        hi = len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = max(data.rfind('\n', lo, mid) + 1, lo)
+            end, linePath, owners = self._line(start)
+            if linePath == path:
+                return owners
+            if linePath < path:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def _check(self, db):
+        """
+        Discard the recorded answers unless a sample of them matches
+        the database.
+        """
+        data = self.data
+        size = len(data) - self.start
+        starts = set()
+        for i in range(self.checkCount):
+            pos = self.start + size * i // self.checkCount
+            starts.add(max(data.rfind('\n', self.start, pos) + 1,
+                           self.start))
+        for start in sorted(starts):
+            end, path, owners = self._line(start)
+            if owners != _dbOwners(db, path):
+                data.close()
+                self.data = ''
+                self.start = 0
+                return
+
+    def _record(self, path, owners):
+        """
+        Append the answer for C{path} to the journal in a single write,
+        so that concurrent cooks appending to it do not interleave.
+        Recording stops after the first failure, which is kept in
+        C{error}.
+        """
+        self.added[path] = owners
+        if self.error is not None:
+            return
+        record = '%s\0\0%s%s\n' % (self.header, path, ''.join(
+            '\0' + (x[1] and '+' or '-') + x[0] for x in owners))
+        try:
+            util.mkdirChain(os.path.dirname(self.journalPath))
+            fd = os.open(self.journalPath,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+        except EnvironmentError, e:
+            self.error = e
+
+    def owners(self, db, path):
+        """
+        Return a list of (trove name, provides path) for the troves
+        that own C{path}.
+        """
+        if not self.checked:
+            self.checked = True
+            if self.data:
+                self._check(db)
+        owners = self.added.get(path)
+        if owners is None and self.data:
+            owners = self._find(path)
+        if owners is None:
+            owners = _dbOwners(db, path)
+            if '\n' not in path and '\0' not in path:
+                self._record(path, owners)
+        return owners
+
+
+def _ownershipSnapshotPath(recipe):
+    """
+    Return the path of the ownership snapshot file for the local
+    database and its current change marker, or (None, None) if
+    snapshots are not enabled.
+    """
+    try:
+        snapshotDir = recipe.macros['pathownershipsnapshot']
+    except KeyError:
+        return None, None
+    if not snapshotDir:
+        return None, None
+    cfg = recipe.cfg
+    dbDir = os.path.realpath(util.joinPaths(cfg.root, cfg.dbPath))
+    try:
+        st = os.stat(util.joinPaths(dbDir, 'conarydb'))
+    except OSError:
+        return None, None
+    marker = '%d %d %r' % (st.st_ino, st.st_size, st.st_mtime)
+    name = sha1helper.sha1ToString(sha1helper.sha1String(dbDir))
+    return util.joinPaths(snapshotDir, name), marker
+
+
+def _getOwnershipSnapshot(recipe):
+    """
+    Return the ownership snapshot of the local database, or None if
+    snapshots are not enabled.
+    """
+    snapshot = getattr(recipe, '_ownershipSnapshot', None)
+    if snapshot is None:
+        snapshot = False
+        path, marker = _ownershipSnapshotPath(recipe)
+        if path is not None:
+            try:
+                snapshot = _OwnershipSnapshot(path, marker)
+            except (EnvironmentError, ValueError):
+                snapshot = False
+        recipe._ownershipSnapshot = snapshot
+    return snapshot or None
+
+
+def _troveNamesByPath(recipe, db, path):
+    """
+    Return the names of the troves in the local database that own
+    C{path}, through the ownership snapshot when it is enabled.
+    """
+    snapshot = _getOwnershipSnapshot(recipe)
+    if snapshot is not None:
+        return [ x[0] for x in snapshot.owners(db, path) ]
+    return [ x.getName() for x in db.iterTrovesByPath(path) ]
+
 
 class ResolveFileDependencies(policy.PackagePolicy):
     """
@@ -68,6 +606,10 @@ class ResolveFileDependencies(policy.PackagePolicy):
     )
     processUnmodified = True
 
+    def __init__(self, *args, **keywords):
+        policy.PackagePolicy.__init__(self, *args, **keywords)
+        _shareRepositoryHelpers(self.recipe)
+
     def do(self):
         self.cfg = self.recipe.cfg
         self.repos = self.recipe.getRepos()
@@ -81,16 +623,17 @@ class ResolveFileDependencies(policy.PackagePolicy):
             for comp in self.recipe.autopkg.getComponents():
                 comp.requires -= comp.provides
 
+        reList = [re.compile(x % self.macros) for x in self.exceptions or []]
+        self.localTroves = {}
+
+        compDeps = []
         for comp in self.recipe.autopkg.getComponents():
             req = comp.requires
-            prov = comp.provides
 
             # get the deps that we want to resolve
             proposedFileDeps = set(req.iterDepsByClass(deps.FileDependencies))
             fileDeps = set()
-            if self.exceptions:
-                reList = [re.compile(x % self.macros)
-                           for x in self.exceptions]
+            if reList:
                 for f in proposedFileDeps:
                     for r in reList:
                         if r.match(str(f)):
@@ -107,85 +650,147 @@ class ResolveFileDependencies(policy.PackagePolicy):
             removedFileDeps = []
 
             self.resolveLocal(fileDeps, comp, addedTroveDeps, removedFileDeps)
-            self.resolveRepo(fileDeps, comp, addedTroveDeps, removedFileDeps)
+            compDeps.append((comp, fileDeps, addedTroveDeps, removedFileDeps))
+
+        # look up what is left for all the components together
+        self.resolveRepo(compDeps)
 
+        for comp, fileDeps, addedTroveDeps, removedFileDeps in compDeps:
             # update the components deps
             if len(addedTroveDeps):
-                req.addDeps(deps.TroveDependencies,addedTroveDeps)
-                req.removeDeps(deps.FileDependencies,removedFileDeps)
-
-    def resolveLocal(self, fileDeps, comp, addedTroveDeps, removedFileDeps):
-        if not fileDeps:
-            return
-
-        locDepSets = set()
-        trvMap = {}
-        for fDep in fileDeps.copy():
-            f = str(fDep)
+                comp.requires.addDeps(deps.TroveDependencies,addedTroveDeps)
+                comp.requires.removeDeps(deps.FileDependencies,removedFileDeps)
+
+        snapshot = _getOwnershipSnapshot(self.recipe)
+        if snapshot is not None and snapshot.error is not None:
+            self.warn('could not record path ownership answers in %s: %s',
+                      snapshot.journalPath, snapshot.error)
+
+    def _findLocalTroves(self, fDep):
+        """
+        Return (satisfied, trove name) for the file dependency fDep from
+        the local database: whether a trove owning the path provides it,
+        and otherwise the name of the first trove owning the path, if any.
+        """
+        if fDep not in self.localTroves:
+            snapshot = _getOwnershipSnapshot(self.recipe)
+            if snapshot is not None:
+                owners = snapshot.owners(self.db, str(fDep))
+                satisfied = bool([ x for x in owners if x[1] ])
+                self.localTroves[fDep] = (satisfied,
+                                          owners and owners[0][0] or None)
+                return self.localTroves[fDep]
             trv0 = None
-            for trv in self.db.iterTrovesByPath(f):
+            satisfied = False
+            for trv in self.db.iterTrovesByPath(str(fDep)):
                 if not trv0:
                     trv0 = trv
                 if trv.provides().satisfies(
                         self.toDepSet(fDep,deps.FileDependencies)):
-                    fileDeps.remove(fDep)
+                    satisfied = True
                     break
-            else:
-                if trv0:
-                    trovName = trv0.getName()
-                    self.info("Replacing requirement on file %s with a "
-                            "requirement on trove %s since that file is not "
-                            "directly provided." % (f, trovName))
-                    addedTroveDeps.append(deps.Dependency(trovName))
-                    removedFileDeps.append(fDep)
-                    fileDeps.remove(fDep)
-
-    def resolveRepo(self,fileDeps, comp, addedTroveDeps, removedFileDeps):
+            self.localTroves[fDep] = (satisfied, trv0 and trv0.getName())
+        return self.localTroves[fDep]
+
+    def resolveLocal(self, fileDeps, comp, addedTroveDeps, removedFileDeps):
         if not fileDeps:
             return
 
-        resolvedDeps = set()
-        for label in self.cfg.installLabelPath:
-            solMap = self.repos.resolveDependencies(
-                label, self.toDepSets(fileDeps,deps.FileDependencies),
-                leavesOnly=True)
+        for fDep in fileDeps.copy():
+            satisfied, trovName = self._findLocalTroves(fDep)
+            if satisfied:
+                fileDeps.remove(fDep)
+            elif trovName:
+                f = str(fDep)
+                self.info("Replacing requirement on file %s with a "
+                        "requirement on trove %s since that file is not "
+                        "directly provided." % (f, trovName))
+                addedTroveDeps.append(deps.Dependency(trovName))
+                removedFileDeps.append(fDep)
+                fileDeps.remove(fDep)
+
+    def resolveRepo(self, compDeps):
+        """
+        Resolve the file dependencies still unresolved for each
+        (component, fileDeps, addedTroveDeps, removedFileDeps) in
+        compDeps against the installLabelPath, querying each label
+        once for the union of the dependencies of all the components.
+        """
+        allDeps = set()
+        for comp, fileDeps, addedTroveDeps, removedFileDeps in compDeps:
+            allDeps.update(fileDeps)
+        if not allDeps:
+            return
+
+        # flavors of the troves providing each dependency, on any label
+        solFlavors = {}
+        depSets = self.toDepSets(allDeps,deps.FileDependencies)
+        cache = _getRepositoryCache(self)
+        if cache is not None:
+            query = lambda repos, label: cache.resolveDependencies(
+                repos, label, depSets)
+        else:
+            query = lambda repos, label: repos.resolveDependencies(
+                label, depSets, leavesOnly=True)
+        for solMap in _labelQueries(self.recipe, self.cfg.installLabelPath,
+                                    query):
             for r in solMap:
                 solList = solMap[r]
-                for s in itertools.chain(*solList):
-                    if s[2].satisfies(comp.flavor):
-                        fDep = list(r.iterDeps())[0][1]
+                fDep = list(r.iterDeps())[0][1]
+                solFlavors.setdefault(fDep, []).extend(
+                    s[2] for s in itertools.chain(*solList))
+
+        unresolved = []
+        paths = set()
+        for comp, fileDeps, addedTroveDeps, removedFileDeps in compDeps:
+            resolvedDeps = set()
+            for fDep in fileDeps:
+                for flavor in solFlavors.get(fDep, []):
+                    if flavor.satisfies(comp.flavor):
                         resolvedDeps.add(fDep)
                         break
-        unresolvedDeps = fileDeps - resolvedDeps
+            unresolvedDeps = fileDeps - resolvedDeps
+            if unresolvedDeps:
+                unresolved.append((comp, unresolvedDeps, fileDeps,
+                                   addedTroveDeps, removedFileDeps))
+                paths.update(str(x) for x in unresolvedDeps)
 
-        if not unresolvedDeps:
+        if not paths:
             return
 
-        paths = [str(x) for x in unresolvedDeps]
+        paths = sorted(paths)
         trvMap = {}
-        presolvedDeps = set()
-        for label in self.cfg.installLabelPath:
-            pathDict = self.repos.getTroveLeavesByPath(paths, label)
+        if cache is not None:
+            query = lambda repos, label: cache.getTroveLeavesByPath(
+                repos, paths, label)
+        else:
+            query = lambda repos, label: repos.getTroveLeavesByPath(
+                paths, label)
+        for pathDict in _labelQueries(self.recipe, self.cfg.installLabelPath,
+                                      query):
             for p in pathDict:
                 if p not in trvMap and pathDict[p]:
                     trvMap[p] = pathDict[p]
-                    presolvedDeps.add(deps.Dependency(p))
 
-        if not presolvedDeps:
+        if not trvMap:
             return
 
-        for fDep in presolvedDeps:
-            f = str(fDep)
-            for nvf in trvMap[f]:
-                if nvf[2].satisfies(comp.flavor):
-                    trovName = nvf[0]
-                    self.info("Replacing requirement on file %s with a "
-                            "requirement on trove %s since that file is not "
-                            "directly provided." % (f, trovName))
-                    addedTroveDeps.append(deps.Dependency(trovName))
-                    removedFileDeps.append(fDep)
-                    fileDeps.remove(fDep)
-                    break
+        for (comp, unresolvedDeps, fileDeps,
+             addedTroveDeps, removedFileDeps) in unresolved:
+            presolvedDeps = set(deps.Dependency(str(x))
+                                for x in unresolvedDeps if str(x) in trvMap)
+            for fDep in presolvedDeps:
+                f = str(fDep)
+                for nvf in trvMap[f]:
+                    if nvf[2].satisfies(comp.flavor):
+                        trovName = nvf[0]
+                        self.info("Replacing requirement on file %s with a "
+                                  "requirement on trove %s since that file "
+                                  "is not directly provided." % (f, trovName))
+                        addedTroveDeps.append(deps.Dependency(trovName))
+                        removedFileDeps.append(fDep)
+                        fileDeps.remove(fDep)
+                        break
 
     def toDepSet(self, dep, depClass):
         ds = deps.DependencySet()
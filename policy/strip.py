@@ -26,6 +26,18 @@ from conary.build.use import Use
 from conary.local import database
 
 
+# reads the ownership snapshot shared by resolvefiledeps.py
+def _troveNamesByPath(recipe, db, path):
+    """
+    Return the names of the troves in the local database that own
+    C{path}, through the path ownership snapshot of
+    ResolveFileDependencies when it is loaded.
+    """
+    if hasattr(recipe, '_troveNamesByPath'):
+        return recipe._troveNamesByPath(db, path)
+    return [ x.getName() for x in db.iterTrovesByPath(path) ]
+
+
 def _findProgPath(prog, db, recipe, error=True):
     # ignore arguments
     prog = prog.split(' ')[0]
@@ -46,7 +58,7 @@ def _findProgPath(prog, db, recipe, error=True):
     if not progPath and not error:
         return None
 
-    progTroveName =  [ x.getName() for x in db.iterTrovesByPath(progPath) ]
+    progTroveName = _troveNamesByPath(recipe, db, progPath)
     if progTroveName:
         progTroveName = progTroveName[0]
         try:
@@ -15,8 +15,10 @@
 #
 
 
+import bisect
 import os
 import re
+import stat
 
 from conary.build import filter, policy, packagepolicy
 from conary.deps import deps
@@ -31,6 +33,137 @@ else:
     # will then be ignored.
     _basePluggableRequires = object
 
+class _SymlinkTable(object):
+    """
+    Cook-wide table of the symlinks in the destdir, shared through the
+    recipe by the symlink policies (and, when present, by other policies
+    that look at links).  Each entry is checked against the inode and
+    ctime of the link, so links replaced by anything else are read again.
+    """
+    def __init__(self, destdir):
+        self.destdir = destdir
+        self.links = {}
+
+    def readlink(self, path, st=None):
+        """
+        Return the contents of the symlink at C{path} in the destdir,
+        or None if C{path} is not a symlink.  C{st} is the lstat of
+        the path, if the caller already has it.
+        """
+        fullpath = self.destdir + path
+        if st is None:
+            try:
+                st = os.lstat(fullpath)
+            except OSError:
+                st = None
+        if st is None or not stat.S_ISLNK(st.st_mode):
+            self.links.pop(path, None)
+            return None
+        key = (st.st_ino, st.st_ctime)
+        entry = self.links.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        contents = os.readlink(fullpath)
+        self.links[path] = (key, contents)
+        return contents
+
+    def setlink(self, path, contents):
+        """
+        Replace the symlink at C{path} in the destdir with one
+        pointing to C{contents}.
+        """
+        fullpath = self.destdir + path
+        os.unlink(fullpath)
+        os.symlink(contents, fullpath)
+        st = os.lstat(fullpath)
+        self.links[path] = ((st.st_ino, st.st_ctime), contents)
+
+    def resolver(self):
+        return _SymlinkResolver(self)
+
+
+class _SymlinkResolver(object):
+    """
+    C{os.path.realpath} that remembers every link it resolves and every
+    path component it finds not to be a link, so that links shared by
+    many paths, such as symlinked directories, are only followed once.
+    The filesystem must not change while a resolver is in use; create
+    one for each policy run.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.destdir = table.destdir
+        self.contents = {}
+        self.resolved = {}
+        self.realDestdir = self.realpath(self.destdir)
+
+    def _readlink(self, fullpath):
+        if fullpath not in self.contents:
+            if fullpath.startswith(self.destdir + '/'):
+                contents = self.table.readlink(fullpath[len(self.destdir):])
+            else:
+                try:
+                    contents = os.readlink(fullpath)
+                except OSError:
+                    contents = None
+            self.contents[fullpath] = contents
+        return self.contents[fullpath]
+
+    def _join(self, path, rest, pending):
+        # follows posixpath._joinrealpath
+        if rest.startswith('/'):
+            rest = rest[1:]
+            path = '/'
+        while rest:
+            name, _, rest = rest.partition('/')
+            if not name or name == '.':
+                continue
+            if name == '..':
+                if path:
+                    path, name = os.path.split(path)
+                    if name == '..':
+                        path = os.path.join(path, '..', '..')
+                else:
+                    path = '..'
+                continue
+            newpath = os.path.join(path, name)
+            contents = self._readlink(newpath)
+            if contents is None:
+                path = newpath
+                continue
+            if newpath in self.resolved:
+                path = self.resolved[newpath]
+                continue
+            if newpath in pending:
+                # symlink loop
+                return os.path.join(newpath, rest), False
+            pending.add(newpath)
+            path, ok = self._join(path, contents, pending)
+            if not ok:
+                return os.path.join(path, rest), False
+            self.resolved[newpath] = path
+        return path, True
+
+    def realpath(self, fullpath):
+        return os.path.abspath(self._join('', fullpath, set())[0])
+
+    def resolve(self, path):
+        """
+        Return C{path} in the destdir with all symlinks resolved,
+        relative to the destdir.
+        """
+        realpath = self.realpath(self.destdir + path)
+        return realpath[len(self.realDestdir):]
+
+
+def _getSymlinkTable(recipe):
+    table = getattr(recipe, '_symlinkTable', None)
+    if table is None:
+        table = _SymlinkTable(recipe.macros.destdir)
+        recipe._symlinkTable = table
+    return table
+
+
 class FixBuilddirSymlink(policy.DestdirPolicy):
     """
     NAME
@@ -68,11 +201,11 @@ class FixBuilddirSymlink(policy.DestdirPolicy):
                 return
 
         d = self.macros.destdir
-        f = util.joinPaths(d, path)
-        if not os.path.islink(f):
+        table = _getSymlinkTable(self.recipe)
+        contents = table.readlink(path)
+        if contents is None:
             return
 
-        contents = os.readlink(f)
         builddir = self.recipe.macros.builddir
         if contents.startswith(builddir):
             newContents = os.path.normpath(contents[len(builddir):])
@@ -81,8 +214,11 @@ class FixBuilddirSymlink(policy.DestdirPolicy):
                 return
             self.info('removing builddir from symlink %s: %s becomes %s',
                       path, contents, newContents)
-            os.unlink(f)
-            os.symlink(newContents, f)
+            table.setlink(path, newContents)
+            # the library inventory of libraries.py, if taken yet
+            inventory = getattr(self.recipe, '_libraryInventory', None)
+            if inventory is not None:
+                inventory.update(path)
 
 class SymlinkTargetRequires(_basePluggableRequires):
     """
@@ -124,13 +260,12 @@ class SymlinkTargetRequires(_basePluggableRequires):
 
     def addPluggableRequirements(self, path, fullpath, pkgFiles, macros):
         d = macros.destdir
-        f = util.joinPaths(d, path)
-        if not os.path.islink(f):
+        contents = _getSymlinkTable(self.recipe).readlink(path)
+        if contents is None:
             return
         self._openDb()
 
         fullpath = util.joinPaths(d, path)
-        contents = os.readlink(fullpath)
         if not contents.startswith(os.path.sep):
             # contents is normally a relative symlink thanks to
             # the RelativeSymlinks policy. if it's not, then we have an
@@ -201,9 +336,9 @@ class RelativeSymlinks(policy.DestdirPolicy):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        fullpath = self.macros['destdir']+path
-        if os.path.islink(fullpath):
-            contents = os.readlink(fullpath)
+        table = _getSymlinkTable(self.recipe)
+        contents = table.readlink(path)
+        if contents is not None:
             if contents.startswith('/'):
                 pathlist = util.normpath(path).split('/')
                 contentslist = util.normpath(contents).split('/')
@@ -213,11 +348,14 @@ class RelativeSymlinks(policy.DestdirPolicy):
                 while contentslist and pathlist[0] == contentslist[0]:
                     pathlist = pathlist[1:]
                     contentslist = contentslist[1:]
-                os.remove(fullpath)
                 dots = "../"
                 dots *= len(pathlist) - 1
                 normpath = util.normpath(dots + '/'.join(contentslist))
-                os.symlink(normpath, fullpath)
+                table.setlink(path, normpath)
+                # the library inventory of libraries.py, if taken yet
+                inventory = getattr(self.recipe, '_libraryInventory', None)
+                if inventory is not None:
+                    inventory.update(path)
 
 
 class DanglingSymlinks(policy.PackagePolicy):
@@ -267,49 +405,75 @@ class DanglingSymlinks(policy.PackagePolicy):
         for targetitem, requirement in self.targetexceptions:
             filterargs = self.filterExpression(targetitem)
             self.targetFilters.append((filter.Filter(*filterargs), requirement))
+        self.packagedPaths = None
+        self.components = {}
+        self.componentDeps = {}
+        self.symlinks = _getSymlinkTable(recipe)
+        self.resolver = self.symlinks.resolver()
         policy.PackagePolicy.doProcess(self, recipe)
 
+    def _dependsOn(self, fromPkg, targetPkg):
+        """
+        Return True if C{targetPkg} provides any of the requirements of
+        C{fromPkg}; computed once for each pair of components.
+        """
+        targets = self.componentDeps.setdefault(fromPkg.getName(), {})
+        targetName = targetPkg.getName()
+        if targetName not in targets:
+            found = False
+            provides = targetPkg.provides
+            for depClass, dep in fromPkg.requires.iterDeps():
+                d = deps.DependencySet()
+                d.addDep(depClass, dep)
+                if provides.satisfies(d):
+                    found = True
+                    break
+            targets[targetName] = found
+        return targets[targetName]
+
+    def _findComponent(self, path):
+        if path not in self.components:
+            self.components[path] = self.recipe.autopkg.findComponent(path)
+        return self.components[path]
+
+    def _packagedUnder(self, prefix):
+        """
+        Return True if any packaged path starts with C{prefix}.
+        """
+        if self.packagedPaths is None:
+            self.packagedPaths = sorted(self.recipe.autopkg.pathMap)
+        i = bisect.bisect_left(self.packagedPaths, prefix)
+        return (i < len(self.packagedPaths)
+                and self.packagedPaths[i].startswith(prefix))
+
     def doFile(self, path):
         if hasattr(self.recipe, '_getCapsulePathsForFile'):
             if self.recipe._getCapsulePathsForFile(path):
                 return
 
-        d = self.macros.destdir
-        f = util.joinPaths(d, path)
-        if not os.path.islink(f):
+        contents = self.symlinks.readlink(path)
+        if contents is None:
             return
 
         recipe = self.recipe
-        contents = os.readlink(f)
         if contents[0] == '/':
             self.warn('Absolute symlink %s points to %s,'
                       ' should probably be relative', path, contents)
             return
         abscontents = util.joinPaths(os.path.dirname(path), contents)
         # now resolve any intermediate symlinks
-        dl = len(os.path.realpath(d))
-        abscontents = os.path.realpath(d+abscontents)[dl:]
+        abscontents = self.resolver.resolve(abscontents)
         ap = recipe.autopkg
         if abscontents in ap.pathMap:
-            if ap.findComponent(abscontents) != ap.findComponent(path) and \
+            fromPkg = self._findComponent(path)
+            targetPkg = self._findComponent(abscontents)
+            if targetPkg != fromPkg and \
                not path.endswith('.so') and \
-               not ap.findComponent(path).getName().endswith(':test'):
+               not fromPkg.getName().endswith(':test'):
                 # warn about suspicious cross-component symlink
-                fromPkg = ap.findComponent(path)
-                targetPkg = ap.findComponent(abscontents)
-
-                found = False
-                for depClass, dep in fromPkg.requires.iterDeps():
-                    d = deps.DependencySet()
-                    d.addDep(depClass, dep)
-                    if targetPkg.provides.satisfies(d):
-                        found = True
-                        break
-
-                if not found:
+                if not self._dependsOn(fromPkg, targetPkg):
                     self.warn('symlink %s points from package %s to %s',
-                              path, ap.findComponent(path).getName(),
-                              ap.findComponent(abscontents).getName())
+                              path, fromPkg.getName(), targetPkg.getName())
         else:
             for targetFilter, requirement in self.targetFilters:
                 if targetFilter.match(abscontents):
@@ -320,7 +484,7 @@ class DanglingSymlinks(policy.PackagePolicy):
                         self.info('automatically adding requirement'
                                   ' %s for symlink %s', requirement, path)
                         # Requires has already run, touch this up
-                        pkg = ap.findComponent(path)
+                        pkg = self._findComponent(path)
                         if path not in pkg.requiresMap:
                             pkg.requiresMap[path] = deps.DependencySet()
                         pkg.requiresMap[path].addDep(
@@ -329,13 +493,13 @@ class DanglingSymlinks(policy.PackagePolicy):
                         f = pkg.getFile(path)
                         f.requires.set(pkg.requiresMap[path])
                         pkg.requires.union(f.requires())
+                        self.componentDeps.pop(pkg.getName(), None)
                     return
-            for pathName in recipe.autopkg.pathMap:
-                if pathName.startswith(abscontents):
-                    # a link to a subdirectory of a file that is
-                    # packaged is still OK; this test is expensive
-                    # and almost never needed, so put off till last
-                    return
+            if self._packagedUnder(abscontents):
+                # a link to a subdirectory of a file that is
+                # packaged is still OK; put off till last since
+                # it is almost never needed
+                return
             self.error(
                 "Dangling symlink: %s points to non-existant %s (%s)"
                 %(path, contents, abscontents))
@@ -343,3 +507,12 @@ class DanglingSymlinks(policy.PackagePolicy):
             # so the rest of policy won't barf trying to access a file which
             # doesn't *really* exist (CNP-59)
             os.unlink(self.recipe.macros.destdir+path)
+            self.resolver = self.symlinks.resolver()
+            # the path lint snapshot of badpathnames.py, if taken yet
+            pathLint = getattr(self.recipe, '_pathLint', None)
+            if pathLint is not None:
+                pathLint.invalidate()
+            # and the library inventory of libraries.py
+            inventory = getattr(self.recipe, '_libraryInventory', None)
+            if inventory is not None:
+                inventory.update(path)
@@ -25,6 +25,21 @@ else:
     # will then be ignored.
     _basePluggableRequires = object
 
+# copied from badfilecontents.py
+def _strippedLines(path):
+    """
+    Yield the non-blank lines of the file at path, stripped of leading
+    and trailing whitespace, reading only as far as the caller iterates.
+    """
+    f = file(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        f.close()
+
 class XinetdConfigRequires(_basePluggableRequires):
     """
     NAME
@@ -70,13 +85,11 @@ class XinetdConfigRequires(_basePluggableRequires):
 
     def addPluggableRequirements(self, path, fullpath, pkgFiles, macros):
 
-        # parse file
-        fContents = [x.strip() for x in file(fullpath).readlines()]
         # Although the line says "disable", we use "enabled", so that if the
         # line is not present at all we don't generate the dep
         enabled = None
-        for fLine in fContents:
-            if not fLine or fLine[0] == '#':
+        for fLine in _strippedLines(fullpath):
+            if fLine[0] == '#':
                 continue
             arr = [x.strip() for x in fLine.split('=', 1) ]
             if len(arr) != 2: